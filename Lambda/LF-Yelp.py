@@ -1,9 +1,20 @@
 import json
-import boto3
 import datetime
-import requests
-from elasticsearch import Elasticsearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
+import hashlib
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from decimal import Decimal
+
+import clients
+import cuisines
+import dynamo
+import geo
+import metrics
+import snapshot
+import throttle
 
 API_KEY = '######################SECRET######################################'
 ENDPOINT = 'https://api.yelp.com/v3/businesses/search'
@@ -13,111 +24,1243 @@ LOCATION = 'manhattan'
 SEARCH_RADIUS = 40000
 YELP_LIMIT = 50
 
-# --------------------------------- MAIN ---------------------------------
+# --------------------------------- fetch restaurants from Yelp ---------------------------------
 
-def lambda_handler(event, context):
-    resultData = []
-    
-    for cuisine in CUISINES: #need to run just for 2 cuisines for each execution, since lambda has execution time limit
-        for i in range(20):
-            requestData = {
-                        'term': cuisine,
-                        'limit': YELP_LIMIT,
-                        'radius': SEARCH_RADIUS,
-                        'offset': 50 * i,
-                        'location': LOCATION
-                    }
+# Yelp only serves the first 1000 results of a search (offset + limit <= 1000)
+MAX_YELP_RESULTS = 1000
+YELP_QPS = float(os.environ.get('YELP_QPS', '5'))
+FETCH_CONCURRENCY = int(os.environ.get('FETCH_CONCURRENCY', '8'))
+FETCH_MAX_ATTEMPTS = 5
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+yelpRateLimit = throttle.TokenBucket(YELP_QPS)
+
+def fetchPage(cuisine, offset):
+    requestData = {
+                'term': cuisine,
+                'limit': YELP_LIMIT,
+                'radius': SEARCH_RADIUS,
+                'offset': offset,
+                'location': LOCATION
+            }
+
+    headers = {
+        'Authorization': 'Bearer %s' % API_KEY,
+    }
+
+    for attempt in range(FETCH_MAX_ATTEMPTS):
+        yelpRateLimit.acquire()
+        with metrics.span('yelp', 'search'):
+            response = clients.get_http_session().get(ENDPOINT, headers=headers, params=requestData)
+
+        if response.status_code not in RETRYABLE_STATUS:
+            break
+
+        if attempt + 1 < FETCH_MAX_ATTEMPTS:
+            # honour Retry-After when Yelp sends it
+            retryAfter = response.headers.get('Retry-After')
+            delay = float(retryAfter) if retryAfter and retryAfter.isdigit() else throttle.jittered_backoff(attempt, base=0.5)
+            time.sleep(delay)
+
+    response.raise_for_status()
+    return json.loads(response.text)
+
+def fetchPages(plan, deadline):
+    # Yields (page, message) as pages arrive. Only a bounded number of pages
+    # is in flight at once, so memory does not grow with the crawl. New
+    # pages are taken from the plan whenever a slot frees up, so pages the
+    # plan learns about from a first page are picked up in the same run.
+    # Pages that fail or would start after the deadline are left out, so a
+    # later run picks them up.
+
+    def fetchBeforeDeadline(page):
+        if time.time() >= deadline:
+            return page, None
+        try:
+            return page, fetchPage(*page)
+        except Exception as e:
+            print(f'Failed to fetch {page}: {e}')
+            return page, None
+
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+        inFlight = set()
+        while True:
+            while len(inFlight) < FETCH_CONCURRENCY * 2:
+                page = plan.nextPage()
+                if page is None:
+                    break
+                inFlight.add(executor.submit(fetchBeforeDeadline, page))
+
+            if not inFlight:
+                return
+
+            done, inFlight = wait(inFlight, return_when=FIRST_COMPLETED)
+            for future in done:
+                page, message = future.result()
+                if message is not None:
+                    yield page, message
+
+
+# --------------------------------- total-aware crawl plan ---------------------------------
+
+class CrawlPlan:
+    # Decides which (cuisine, offset) pages to fetch. Only the first page of
+    # a cuisine is requested up front; the rest are planned from the 'total'
+    # it reports, and a cuisine stops at the first empty page.
+
+    def __init__(self, cuisines, completedPages=(), totals=None, exhausted=None, seenBusinesses=(), buildIndex=None, retryIds=()):
+        self.cuisines = list(cuisines)
+        # versioned index a rebuild is loading, None for an in-place refresh
+        self.buildIndex = buildIndex
+        # restaurants the rebuild index rejected, indexed again before the alias moves
+        self.retryIds = set(retryIds)
+        self.completed = set(completedPages)
+        # every business id seen by this crawl, across resumed invocations
+        self.seenBusinesses = set(seenBusinesses)
+        self.totals = dict(totals or {})
+        self.exhausted = dict(exhausted or {})
+        self.queue = deque()
+        self.stats = {cuisine: {'total': self.totals.get(cuisine), 'pages': 0, 'businesses': 0, 'duplicates': 0} for cuisine in self.cuisines}
+        self.seenIds = {cuisine: set() for cuisine in self.cuisines}
+
+        for cuisine in self.cuisines:
+            if cuisine in self.totals:
+                self.queue.extend(self.plannedPages(cuisine))
+            else:
+                self.queue.append((cuisine, 0))
+
+    def lastOffset(self, cuisine):
+        # offsets at or after this one would return nothing
+        end = min(self.totals[cuisine], MAX_YELP_RESULTS)
+        return min(end, self.exhausted.get(cuisine, end))
+
+    def plannedPages(self, cuisine):
+        return [(cuisine, offset) for offset in range(0, self.lastOffset(cuisine), YELP_LIMIT)
+                if pageKey((cuisine, offset)) not in self.completed]
+
+    def nextPage(self):
+        while self.queue:
+            cuisine, offset = self.queue.popleft()
+            if offset == 0 or offset < self.lastOffset(cuisine):
+                return cuisine, offset
+        return None
+
+    def pageFetched(self, page, message):
+        cuisine, offset = page
+        businesses = message.get('businesses') or []
+        self.completed.add(pageKey(page))
+
+        stats = self.stats[cuisine]
+        stats['pages'] += 1
+        for business in businesses:
+            self.seenBusinesses.add(business['id'])
+            if business['id'] in self.seenIds[cuisine]:
+                stats['duplicates'] += 1
+            else:
+                self.seenIds[cuisine].add(business['id'])
+                stats['businesses'] += 1
+
+        if not businesses:
+            self.exhausted[cuisine] = min(offset, self.exhausted.get(cuisine, offset))
+
+        if cuisine not in self.totals:
+            self.totals[cuisine] = stats['total'] = int(message.get('total', 0))
+            self.queue.extend(page for page in self.plannedPages(cuisine) if page[1] != 0)
+
+    def remainingPages(self):
+        remaining = 0
+        for cuisine in self.cuisines:
+            if cuisine in self.totals:
+                remaining += len(self.plannedPages(cuisine))
+            else:
+                remaining += 1
+        return remaining
+
+
+# --------------------------------- resumable crawl checkpoint ---------------------------------
+
+STATE_TABLE = 'YelpIngestState'
+CHECKPOINT_ID = 'yelp-ingest-checkpoint'
+GENERATION_ID = 'ingest-generation'
+# Share of the remaining time kept back at the end of an invocation, at
+# most WRITE_RESERVE_MAX_MS. Pages are written while the crawl runs, so it
+# only covers the last flush, the checkpoint and finishing the crawl.
+WRITE_RESERVE_FRACTION = float(os.environ.get('WRITE_RESERVE_FRACTION', '0.2'))
+WRITE_RESERVE_MAX_MS = int(os.environ.get('WRITE_RESERVE_MAX_MS', '20000'))
+
+def pageKey(page):
+    return '%s|%d' % page
+
+def loadCheckpoint(cuisines):
+    with metrics.span('dynamodb', 'get_item'):
+        response = clients.get_table(STATE_TABLE).get_item(Key={'id': CHECKPOINT_ID}, ConsistentRead=True)
+    item = response.get('Item', {})
+    return CrawlPlan(
+        cuisines,
+        completedPages = item.get('completedPages', []),
+        totals = {cuisine: int(total) for cuisine, total in item.get('totals', {}).items()},
+        exhausted = {cuisine: int(offset) for cuisine, offset in item.get('exhausted', {}).items()},
+        seenBusinesses = item.get('seenBusinesses', []),
+        buildIndex = item.get('buildIndex'),
+        retryIds = item.get('retryIds', [])
+    )
+
+def saveCheckpoint(plan):
+    with metrics.span('dynamodb', 'put_item'):
+        clients.get_table(STATE_TABLE).put_item(
+            Item={
+                'id': CHECKPOINT_ID,
+                'buildIndex': plan.buildIndex,
+                'completedPages': sorted(plan.completed),
+                'totals': plan.totals,
+                'exhausted': plan.exhausted,
+                'seenBusinesses': sorted(plan.seenBusinesses),
+                'retryIds': sorted(plan.retryIds),
+                'updatedAtTimestamp': str(datetime.datetime.now())
+            }
+        )
+
+def clearCheckpoint():
+    with metrics.span('dynamodb', 'delete_item'):
+        clients.get_table(STATE_TABLE).delete_item(Key={'id': CHECKPOINT_ID})
+
+def nextGeneration():
+    with metrics.span('dynamodb', 'get_item'):
+        response = clients.get_table(STATE_TABLE).get_item(Key={'id': GENERATION_ID}, ConsistentRead=True)
+    return int(response.get('Item', {}).get('generation', 0)) + 1
+
+def publishGeneration(generation):
+    # LF2 drops its cached candidate pools when this number moves, and
+    # downloads the snapshot of it once. So the snapshot is uploaded first.
+    with metrics.span('dynamodb', 'update_item'):
+        clients.get_table(STATE_TABLE).update_item(
+            Key = {'id': GENERATION_ID},
+            UpdateExpression = 'SET generation = :generation, updatedAtTimestamp = :now',
+            ExpressionAttributeValues = {':generation': generation, ':now': str(datetime.datetime.now())}
+        )
+
+def fetchDeadline(context):
+    if context is None:
+        return float('inf')
+    remaining = context.get_remaining_time_in_millis()
+    if remaining <= 0:
+        # fetching nothing would save the same checkpoint again and again
+        raise RuntimeError(f'No time left to fetch pages, {remaining} ms remaining')
+    reserve = min(remaining * WRITE_RESERVE_FRACTION, WRITE_RESERVE_MAX_MS)
+    return time.time() + (remaining - reserve) / 1000.0
+
+
+# --------------------------------- sharded fan-out crawl ---------------------------------
+
+# A coordinator invocation ({"fanout": true}) splits the crawl into work
+# units of SHARD_PAGES pages of one cuisine and queues them on
+# INGEST_QUEUE_URL. Workers, fed by an SQS event source mapping on that
+# queue, fetch and write one unit each. The worker that completes the last
+# unit finishes the crawl: tombstones, the one refresh or alias swap, the
+# location index, the generation and the snapshot.
+INGEST_QUEUE_URL = os.environ.get('INGEST_QUEUE_URL')
+SHARD_PAGES = int(os.environ.get('SHARD_PAGES', '4'))
+FANOUT_ID = 'yelp-ingest-fanout'
+# an unfinished fan-out older than this no longer blocks a new one
+FANOUT_TIMEOUT_SECONDS = int(os.environ.get('FANOUT_TIMEOUT_SECONDS', '3600'))
+SQS_SEND_BATCH_LIMIT = 10  # maximum entries per SendMessageBatch request
+
+class ShardPlan:
+    # The pages of one work unit for fetchPages, up to the first empty page
+
+    def __init__(self, cuisine, start, end):
+        self.cuisine = cuisine
+        self.offsets = range(start, end, YELP_LIMIT)
+        self.queue = deque((cuisine, offset) for offset in self.offsets)
+        self.exhausted = end
+        self.completed = set()
+
+    def nextPage(self):
+        while self.queue:
+            page = self.queue.popleft()
+            if page[1] < self.exhausted:
+                return page
+        return None
+
+    def pageFetched(self, page, message):
+        self.completed.add(page[1])
+        if not message.get('businesses'):
+            self.exhausted = min(self.exhausted, page[1])
+
+    def remainingPages(self):
+        return sum(1 for offset in self.offsets if offset < self.exhausted and offset not in self.completed)
 
-            headers = {
-                'Authorization': 'Bearer %s' % API_KEY,
+def firstPages(cuisineList):
+    # cuisine -> its first page, which reports how many results Yelp has
+    with ThreadPoolExecutor(max_workers=min(FETCH_CONCURRENCY, len(cuisineList))) as executor:
+        return dict(zip(cuisineList, executor.map(lambda cuisine: fetchPage(cuisine, 0), cuisineList)))
+
+def workUnit(crawlId, cuisine, start, end):
+    return {'crawlId': crawlId, 'unitId': pageKey((cuisine, start)), 'cuisine': cuisine, 'start': start, 'end': end}
+
+def workUnits(crawlId, totals):
+    # (first page units, queued units). The coordinator already holds the
+    # first page of each cuisine, so it writes those itself.
+    firstUnits, units = [], []
+    step = YELP_LIMIT * SHARD_PAGES
+    for cuisine, total in totals.items():
+        end = min(total, MAX_YELP_RESULTS)
+        if end <= 0:
+            continue
+        firstUnits.append(workUnit(crawlId, cuisine, 0, min(YELP_LIMIT, end)))
+        for start in range(YELP_LIMIT, end, step):
+            units.append(workUnit(crawlId, cuisine, start, min(start + step, end)))
+    return firstUnits, units
+
+def enqueueUnits(units):
+    sqs = clients.get_client('sqs')
+    for i in range(0, len(units), SQS_SEND_BATCH_LIMIT):
+        entries = [{'Id': str(n), 'MessageBody': json.dumps(unit)} for n, unit in enumerate(units[i:i + SQS_SEND_BATCH_LIMIT])]
+        with metrics.span('sqs', 'send_message_batch'):
+            response = sqs.send_message_batch(QueueUrl=INGEST_QUEUE_URL, Entries=entries)
+        if response.get('Failed'):
+            raise RuntimeError(f"Failed to queue {len(response['Failed'])} work units: {response['Failed']}")
+
+def loadFanout():
+    with metrics.span('dynamodb', 'get_item'):
+        response = clients.get_table(STATE_TABLE).get_item(Key={'id': FANOUT_ID}, ConsistentRead=True)
+    return response.get('Item')
+
+def fanoutRunning(fanout):
+    return (fanout is not None and not fanout.get('finishedAtTimestamp')
+            and time.time() - int(fanout['startedAt']) < FANOUT_TIMEOUT_SECONDS)
+
+def startFanout(event, context):
+    fanout = loadFanout()
+    if fanoutRunning(fanout):
+        return {
+            'statusCode': 409,
+            'body': json.dumps({'message': 'A fan-out crawl is still running', 'crawlId': fanout['crawlId']})
+        }
+    plan = loadCheckpoint(CUISINES)
+    if plan.completed or plan.buildIndex:
+        return {
+            'statusCode': 409,
+            'body': json.dumps({'message': 'A checkpointed crawl is still running', 'remainingPages': plan.remainingPages()})
+        }
+
+    # unique also for fan-outs started within the same second
+    crawlId = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S-') + uuid.uuid4().hex[:8]
+    pages = firstPages(CUISINES)
+    totals = {cuisine: int(message.get('total', 0)) for cuisine, message in pages.items()}
+    firstUnits, units = workUnits(crawlId, totals)
+    unitCount = len(firstUnits) + len(units)
+    if not unitCount:
+        # nothing to crawl, and tombstoning against nothing would empty the catalog
+        return {'statusCode': 200, 'body': json.dumps({'crawlId': None, 'units': 0, 'totals': totals})}
+
+    es = clients.get_elasticsearch()
+    buildIndex = newIndexName() if event.get('rebuild') or needsRebuild(es) else None
+    index = buildIndex or ES_ALIAS
+    createIndex(es, index)
+    # nobody reads a new index until the alias moves, so it is not refreshed at all
+    refreshInterval = beginLoad(es, index, '-1' if buildIndex else LOAD_REFRESH_INTERVAL)
+
+    with metrics.span('dynamodb', 'put_item'):
+        clients.get_table(STATE_TABLE).put_item(
+            Item={
+                'id': FANOUT_ID,
+                'crawlId': crawlId,
+                'units': unitCount,
+                'buildIndex': buildIndex,
+                'refreshInterval': refreshInterval,
+                'totals': totals,
+                'startedAt': int(time.time()),
+                'startedAtTimestamp': str(datetime.datetime.now())
             }
-                
-            response = requests.get(ENDPOINT, headers=headers, params=requestData)
-            message = json.loads(response.text)
-            result = message['businesses']
-            resultData.append(result)
-    
-    # Add data to DynamodDB
-    dynamoInsert(resultData)
-    
-    # Add index data to the ElasticSearch
-    addElasticIndex(resultData)   
-        
+        )
+    fanout = loadFanout()
+    enqueueUnits(units)
+
+    # The first pages were fetched for their totals already. One that fails
+    # here is queued like any other unit, and a worker fetches it again.
+    requeued = []
+    for unit in firstUnits:
+        cuisine = unit['cuisine']
+        try:
+            plan = ShardPlan(cuisine, 0, unit['end'])
+            report, seenBusinesses = writeUnit(unit, fanout, [((cuisine, 0), pages[cuisine])], plan)
+            finishUnit(unit, fanout, report, seenBusinesses)
+        except Exception as e:
+            print(f"Queueing work unit {unit['unitId']} after it failed: {e}")
+            requeued.append(unit)
+    enqueueUnits(requeued)
+
+    queued = len(units) + len(requeued)
+    print(json.dumps({'fanout': {'crawlId': crawlId, 'units': unitCount, 'queued': queued, 'index': index}}))
     return {
         'statusCode': 200,
-        'body': json.dumps('success')
+        'body': json.dumps({'crawlId': crawlId, 'units': unitCount, 'queued': queued, 'index': index, 'totals': totals})
     }
 
+def runUnit(unit, fanout, context):
+    plan = ShardPlan(unit['cuisine'], unit['start'], unit['end'])
+    return writeUnit(unit, fanout, fetchPages(plan, fetchDeadline(context)), plan)
 
-# --------------------------------- insert restaurant info to DynamoDB ---------------------------------
+def writeUnit(unit, fanout, pages, plan):
+    # Writes the (page, message) pairs of one work unit, returns its report
+    # and the ids it saw. Raises when pages or writes are left, so SQS hands
+    # the unit out again. Restaurants Elasticsearch rejected lose their
+    # stored hash, the others are unchanged the second time.
+    buildIndex = fanout.get('buildIndex')
+    stats = {'skipped': 0, 'unchanged': 0}
+    seenCategories = {}
+    seenBusinesses = set()
+
+    with DynamoSink(RESTAURANT_TABLE) as dynamoSink, ElasticSink(buildIndex or ES_ALIAS, manageRefresh=False) as elasticSink:
+        for page, message in pages:
+            plan.pageFetched(page, message)
+            businesses = message.get('businesses') or []
+            seenBusinesses.update(business['id'] for business in businesses)
+            storedHashes = loadStoredHashesFor([business['id'] for business in businesses])
+            entries = uniqueRestaurants(businesses, seenCategories, stats)
+            for tableEntry, changed in markChanged(entries, storedHashes, stats):
+                if changed:
+                    dynamoSink.add(tableEntry)
+                # a rebuild needs every restaurant, changed or not
+                if changed or buildIndex:
+                    elasticSink.add(tableEntry)
+
+    # so the redelivered unit writes the rejected documents again
+    forgetHashes(elasticSink.failedIds())
+
+    remainingPages = plan.remainingPages()
+    failed = dynamoSink.report['failed'] + elasticSink.report['failed']
+    if remainingPages or failed:
+        raise RuntimeError(f"Work unit {unit['unitId']} left {remainingPages} pages and {failed} writes undone")
+
+    report = {
+        'unitId': unit['unitId'],
+        'pages': len(plan.completed),
+        'businesses': len(seenBusinesses),
+        'written': dynamoSink.report['written'],
+        'indexed': elasticSink.report['indexed'],
+        'skipped': stats['skipped'],
+        'unchanged': stats['unchanged']
+    }
+    return report, seenBusinesses
+
+def completeUnit(unit, fanout, seenBusinesses, indexed):
+    # Records the unit on the fan-out item, the completion barrier. True
+    # when it was the last one. Completed units are a set, so a unit SQS
+    # delivers twice is counted once.
+    table = clients.get_table(STATE_TABLE)
+    values = {':unit': {unit['unitId']}, ':crawlId': unit['crawlId']}
+    updateExpression = 'ADD completedUnits :unit'
+    if seenBusinesses:
+        updateExpression += ', seenBusinesses :ids, indexed :indexed'
+        values.update({':ids': seenBusinesses, ':indexed': indexed})
+
+    with metrics.span('dynamodb', 'update_item'):
+        response = table.update_item(
+            Key = {'id': FANOUT_ID},
+            UpdateExpression = updateExpression,
+            ConditionExpression = 'crawlId = :crawlId',
+            ExpressionAttributeValues = values,
+            ReturnValues = 'UPDATED_NEW'
+        )
+    return len(response['Attributes']['completedUnits']) == int(fanout['units'])
+
+def claimFinish(crawlId):
+    # only one worker finishes a crawl, also when the last unit is delivered twice
+    table = clients.get_table(STATE_TABLE)
+    try:
+        with metrics.span('dynamodb', 'update_item'):
+            table.update_item(
+                Key = {'id': FANOUT_ID},
+                UpdateExpression = 'SET finishingAtTimestamp = :now',
+                ConditionExpression = 'crawlId = :crawlId AND attribute_not_exists(finishingAtTimestamp)',
+                ExpressionAttributeValues = {':crawlId': crawlId, ':now': str(datetime.datetime.now())}
+            )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+def releaseFinish():
+    # lets the redelivered last unit finish the crawl after a failure
+    with metrics.span('dynamodb', 'update_item'):
+        clients.get_table(STATE_TABLE).update_item(Key={'id': FANOUT_ID}, UpdateExpression='REMOVE finishingAtTimestamp')
+
+def finishFanout():
+    # Runs once every unit is in: what a single invocation does at the end of its crawl
+    fanout = loadFanout()
+    es = clients.get_elasticsearch()
+    buildIndex = fanout.get('buildIndex')
+    index = buildIndex or ES_ALIAS
+
+    seenBusinesses = fanout.get('seenBusinesses') or set()
+    storedHashes = loadStoredHashes()
+    gone = [businessId for businessId, contentHash in storedHashes.items()
+            if contentHash is not None and businessId not in seenBusinesses]
+    with ElasticSink(index, manageRefresh=False) as elasticSink:
+        tombstoned = tombstoneRestaurants(gone, len(storedHashes), elasticSink)
+
+    # the one refresh of the whole crawl, then readers move to a rebuilt index
+    endLoad(es, index, fanout.get('refreshInterval'))
+    restaurants = list(liveRestaurants())
+    # Not raised: the redelivered last unit would find the same short
+    # catalog, and the fan-out would hold off other crawls until it timed out
+    notServed = None
+    if buildIndex:
+        notServed = serveRebuild(es, buildIndex, restaurants, seenBusinesses)
+
+    locationCells = locationIndex(restaurants)
+    locationIndexChanged = saveLocationIndex(locationCells)
+
+    generation = None
+    if fanout.get('indexed') or tombstoned or locationIndexChanged:
+        generation = nextGeneration()
+        if SNAPSHOT_BUCKET:
+            writeSnapshot(generation, restaurants, locationCells)
+        publishGeneration(generation)
+
+    updateExpression = 'SET finishedAtTimestamp = :now'
+    values = {':now': str(datetime.datetime.now())}
+    if notServed:
+        updateExpression += ', notServed = :notServed'
+        values[':notServed'] = notServed
+    with metrics.span('dynamodb', 'update_item'):
+        clients.get_table(STATE_TABLE).update_item(
+            Key = {'id': FANOUT_ID},
+            UpdateExpression = updateExpression + ' REMOVE seenBusinesses',
+            ExpressionAttributeValues = values
+        )
+    print(json.dumps({'fanoutFinished': {
+        'crawlId': fanout['crawlId'],
+        'units': int(fanout['units']),
+        'businesses': len(seenBusinesses),
+        'tombstoned': tombstoned,
+        'index': index,
+        'notServed': notServed,
+        'generation': generation
+    }}))
+
+def runWorkUnit(unit, context):
+    fanout = loadFanout()
+    if fanout is None or fanout['crawlId'] != unit['crawlId'] or fanout.get('finishedAtTimestamp'):
+        print(f"Skipping work unit {unit['unitId']} of stale crawl {unit['crawlId']}")
+        return
+
+    report, seenBusinesses = runUnit(unit, fanout, context)
+    finishUnit(unit, fanout, report, seenBusinesses)
+
+def finishUnit(unit, fanout, report, seenBusinesses):
+    # passes the barrier, and finishes the crawl after its last unit
+    try:
+        last = completeUnit(unit, fanout, seenBusinesses, report['indexed'])
+    except clients.get_table(STATE_TABLE).meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Crawl {unit['crawlId']} was replaced while work unit {unit['unitId']} ran")
+        return
+    print(json.dumps({'workUnit': report}))
+
+    if last and claimFinish(unit['crawlId']):
+        try:
+            finishFanout()
+        except Exception:
+            releaseFinish()
+            raise
+
+# Requires ReportBatchItemFailures on the event source mapping, so only the
+# failed units of a batch are retried
+def workerHandler(event, context):
+    batchItemFailures = []
+    for record in event['Records']:
+        try:
+            runWorkUnit(json.loads(record['body']), context)
+        except Exception as e:
+            print(f"Failed work unit {record['messageId']}: {e}")
+            batchItemFailures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': batchItemFailures}
+
+
+# --------------------------------- MAIN ---------------------------------
+
+# pages written between checkpoint saves
+CHECKPOINT_EVERY_PAGES = 10
+
+def crawlHandler(event, context):
+    fanout = loadFanout()
+    if fanoutRunning(fanout):
+        return {
+            'statusCode': 409,
+            'body': json.dumps({'message': 'A fan-out crawl is still running', 'crawlId': fanout['crawlId']})
+        }
+
+    # Resume where the previous invocation stopped
+    plan = loadCheckpoint(CUISINES)
+
+    # A rebuild loads a new versioned index and is only started with a new crawl
+    es = clients.get_elasticsearch()
+    if plan.buildIndex is None and not plan.completed and ((event or {}).get('rebuild') or needsRebuild(es)):
+        plan.buildIndex = newIndexName()
+
+    # Hashes of what is stored, so unchanged businesses are not rewritten
+    storedHashes = loadStoredHashes()
+
+    # Each page is normalized once and streamed into DynamoDB and Elasticsearch
+    seenCategories = {}
+    stats = {'skipped': 0, 'unchanged': 0, 'tombstoned': 0, 'locationIndexChanged': False}
+    fetchedPages = 0
+    if plan.buildIndex:
+        # nobody reads the new index until the alias moves, so skip refreshes
+        elasticSink = ElasticSink(plan.buildIndex, loadRefreshInterval='-1')
+    else:
+        elasticSink = ElasticSink(ES_ALIAS)
+    with DynamoSink(RESTAURANT_TABLE) as dynamoSink, elasticSink:
+        if plan.retryIds:
+            for restaurant in dynamo.batch_get(RESTAURANT_TABLE, sorted(plan.retryIds)):
+                elasticSink.add(restaurant)
+
+        for page, message in fetchPages(plan, fetchDeadline(context)):
+            plan.pageFetched(page, message)
+            entries = uniqueRestaurants(message.get('businesses') or [], seenCategories, stats)
+            for tableEntry, changed in markChanged(entries, storedHashes, stats):
+                if changed:
+                    dynamoSink.add(tableEntry)
+                # a rebuild needs every restaurant, changed or not
+                if changed or plan.buildIndex:
+                    elasticSink.add(tableEntry)
+
+            fetchedPages += 1
+            if fetchedPages % CHECKPOINT_EVERY_PAGES == 0:
+                dynamoSink.flush()
+                elasticSink.flush()
+                plan.retryIds = set(elasticSink.failedIds())
+                saveCheckpoint(plan)
+
+        remainingPages = plan.remainingPages()
+        if not remainingPages:
+            # Only a finished crawl knows which businesses disappeared
+            gone = [businessId for businessId, contentHash in storedHashes.items()
+                    if contentHash is not None and businessId not in plan.seenBusinesses]
+            stats['tombstoned'] = tombstoneRestaurants(gone, len(storedHashes), elasticSink)
+
+    # Documents Elasticsearch rejected are indexed again by the next
+    # invocation, and the crawl (and a rebuild with it) does not finish
+    # before they are in. Without their hashes, a crawl that starts over
+    # writes them again too.
+    forgetHashes(elasticSink.failedIds())
+    plan.retryIds = set(elasticSink.failedIds())
+    finished = not remainingPages and not plan.retryIds
+
+    print(json.dumps({'cuisines': plan.stats}))
+
+    notServed = None
+    if not finished:
+        saveCheckpoint(plan)
+    else:
+        restaurants = list(liveRestaurants())
+        if plan.buildIndex:
+            notServed = serveRebuild(es, plan.buildIndex, restaurants, plan.seenBusinesses)
+        # Crawl finished, the next run starts from scratch
+        clearCheckpoint()
+
+        # Which cells of each served location hold restaurants now
+        locationCells = locationIndex(restaurants)
+        stats['locationIndexChanged'] = saveLocationIndex(locationCells)
+
+    # Readers only need to know when what they can search for has changed
+    generation = None
+    changed = elasticSink.report['indexed'] or stats['tombstoned'] or stats['locationIndexChanged']
+    if changed and (not plan.buildIndex or finished):
+        generation = nextGeneration()
+        if finished and SNAPSHOT_BUCKET:
+            writeSnapshot(generation, restaurants, locationCells)
+        publishGeneration(generation)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'fetchedPages': fetchedPages,
+            'remainingPages': remainingPages,
+            'retryIds': len(plan.retryIds),
+            'written': dynamoSink.report['written'],
+            'skipped': stats['skipped'],
+            'unchanged': stats['unchanged'],
+            'tombstoned': stats['tombstoned'],
+            'failed': dynamoSink.report['failed'],
+            'indexed': elasticSink.report['indexed'],
+            'indexFailures': elasticSink.report['failed'],
+            'index': elasticSink.index,
+            'notServed': notServed,
+            'generation': generation,
+            'cuisines': plan.stats
+        })
+    }
+
+@metrics.handler('LF-Yelp')
+def lambda_handler(event, context):
+    event = event or {}
+    # SQS records are work units of a fan-out crawl
+    if event.get('Records'):
+        return workerHandler(event, context)
+    if event.get('fanout'):
+        return startFanout(event, context)
+    return crawlHandler(event, context)
+
+
+# --------------------------------- location to geohash cell index ---------------------------------
+
+LOCATION_INDEX_ID = 'location-cells'
+
+def restaurantCell(restaurant, precision=geo.MAX_PRECISION):
+    if not restaurant.get('latitude') or not restaurant.get('longitude'):
+        return None
+    return geo.encode(float(restaurant['latitude']), float(restaurant['longitude']), precision)
+
+def locationIndex(restaurants):
+    # Served location -> the cells covering it that hold at least one
+    # restaurant. LF2 filters on these instead of computing the cover, so
+    # empty cells (parks, water) never reach a query.
+    locationCells = {}
+    for location in geo.LOCATIONS:
+        cells = geo.location_cells(location)
+        precision = len(cells[0]) if cells else geo.MAX_PRECISION
+        occupied = {restaurantCell(restaurant, precision) for restaurant in restaurants}
+        locationCells[location] = sorted(cell for cell in cells if cell in occupied)
+    return locationCells
+
+def saveLocationIndex(locationCells):
+    # True when the index changed, readers then need a new generation
+    table = clients.get_table(STATE_TABLE)
+    stored = table.get_item(Key={'id': LOCATION_INDEX_ID}, ConsistentRead=True).get('Item', {}).get('locations')
+    if stored == locationCells:
+        return False
+
+    table.put_item(
+        Item={
+            'id': LOCATION_INDEX_ID,
+            'locations': locationCells,
+            'updatedAtTimestamp': str(datetime.datetime.now())
+        }
+    )
+    print(json.dumps({'locationIndex': {location: len(cells) for location, cells in locationCells.items()}}))
+    return True
+
+
+# --------------------------------- compact snapshot for LF2 ---------------------------------
+
+SNAPSHOT_BUCKET = os.environ.get('SNAPSHOT_BUCKET')
+SNAPSHOT_KEY = os.environ.get('SNAPSHOT_KEY', 'snapshots/restaurants.snapshot')
+
+def liveRestaurants():
+    table = clients.get_table(RESTAURANT_TABLE)
+    scanArgs = {
+        'ProjectionExpression': '#id, #name, address, rating, review_count, latitude, longitude, categories, tombstoned',
+        'ExpressionAttributeNames': {'#id': 'id', '#name': 'name'}
+    }
+
+    while True:
+        with metrics.span('dynamodb', 'scan'):
+            response = table.scan(**scanArgs)
+        for item in response['Items']:
+            if not item.get('tombstoned'):
+                yield item
+        if 'LastEvaluatedKey' not in response:
+            return
+        scanArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def writeSnapshot(generation, items, locationCells):
+    # Everything LF2 needs to recommend without Elasticsearch or DynamoDB.
+    # Restaurants are grouped by cuisine and by cuisine within each indexed
+    # cell, so LF2 reads only the cells of the requested location.
+    restaurants = []
+    members = {cuisine: [] for cuisine in cuisines.CUISINE_CATEGORIES}
+    precisions = {len(cell) for cells in locationCells.values() for cell in cells}
+    indexedCells = {cell for cells in locationCells.values() for cell in cells}
+
+    for item in items:
+        aliases = {category['alias'] for category in item.get('categories', [])}
+        itemCells = [restaurantCell(item, precision) for precision in precisions]
+        itemCells = [cell for cell in itemCells if cell in indexedCells]
+        position = len(restaurants)
+        restaurants.append({
+            'id': item['id'],
+            'name': item['name'],
+            'address': ", ".join(item['address'][:-1]), #take out "New York, NY, zipcode"
+            'rating': item['rating'],
+            'review_count': item['review_count'],
+            'latitude': item.get('latitude'),
+            'longitude': item.get('longitude')
+        })
+        for cuisine, cuisineAliases in cuisines.CUISINE_CATEGORIES.items():
+            if aliases.intersection(cuisineAliases):
+                members[cuisine].append(position)
+                for cell in itemCells:
+                    members.setdefault(snapshot.group(cuisine, cell), []).append(position)
+
+    data = snapshot.build_snapshot(generation, restaurants, members)
+    with metrics.span('s3', 'put_object'):
+        clients.get_client('s3').put_object(Bucket=SNAPSHOT_BUCKET, Key=SNAPSHOT_KEY, Body=data)
+    print(json.dumps({'snapshot': {'generation': generation, 'restaurants': len(restaurants), 'bytes': len(data)}}))
+
+
+# --------------------------------- collapse duplicate restaurants ---------------------------------
+
+def restaurantEntry(restaurant):
+    tableEntry = {
+        'id': restaurant['id'],
+        'name': restaurant['name'],
+        'categories': restaurant['categories'],
+        # DynamoDB takes no floats, a Decimal keeps the half stars
+        'rating': Decimal(str(restaurant['rating'])),
+        'review_count': int(restaurant['review_count']),
+        'address': restaurant['location']['display_address']
+    }
+
+    if (restaurant['coordinates'] and restaurant['coordinates']['latitude'] and restaurant['coordinates']['longitude']):
+        tableEntry['latitude'] = str(restaurant['coordinates']['latitude'])
+        tableEntry['longitude'] = str(restaurant['coordinates']['longitude'])
+        tableEntry['geohash'] = restaurantCell(tableEntry)
 
-def dynamoInsert(restaurants):
-    
-    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-    table = dynamodb.Table('YelpRestaurant')
-    
-    for search_block in restaurants:
-        for restaurant in search_block:
-        
-            tableEntry = {
-                'id': restaurant['id'],
-                'name': restaurant['name'],
-                'categories': restaurant['categories'],
-                'rating': int(restaurant['rating']),
-                'review_count': int(restaurant['review_count']),
-                'address': restaurant['location']['display_address']
-            }        
-    
-            if (restaurant['coordinates'] and restaurant['coordinates']['latitude'] and restaurant['coordinates']['longitude']):
-                tableEntry['latitude'] = str(restaurant['coordinates']['latitude'])
-                tableEntry['longitude'] = str(restaurant['coordinates']['longitude'])
-    
-            if (restaurant['location']['zip_code']):
-                tableEntry['zip_code'] = restaurant['location']['zip_code']
-    
-            # Add necessary attributes to the yelp-restaurants table
-            table.put_item(
-                Item={
-                    'insertedAtTimestamp': str(datetime.datetime.now()),
-                    'id': tableEntry['id'],
-                    'name': tableEntry['name'],
-                    'address': tableEntry['address'],
-                    'latitude': tableEntry.get('latitude', None),
-                    'longitude': tableEntry.get('longitude', None),
-                    'review_count': tableEntry['review_count'],
-                    'rating': tableEntry['rating'],
-                    'zip_code': tableEntry.get('zip_code', None),
-                    'categories': tableEntry['categories']
-                   }
+    if (restaurant['location']['zip_code']):
+        tableEntry['zip_code'] = restaurant['location']['zip_code']
+
+    return tableEntry
+
+def mergeCategories(categories, newCategories):
+    aliases = {category['alias'] for category in categories}
+    return categories + [category for category in newCategories if category['alias'] not in aliases]
+
+def uniqueRestaurants(businesses, seenCategories, stats):
+    # The same business shows up under several cuisine terms. Only its
+    # categories are remembered between pages: a repeat that adds categories
+    # is emitted again with the union, any other repeat is skipped.
+    for restaurant in businesses:
+        tableEntry = restaurantEntry(restaurant)
+        categories = seenCategories.get(tableEntry['id'])
+
+        if categories is None:
+            seenCategories[tableEntry['id']] = tableEntry['categories']
+            yield tableEntry
+            continue
+
+        merged = mergeCategories(categories, tableEntry['categories'])
+        if len(merged) == len(categories):
+            stats['skipped'] += 1
+            continue
+
+        seenCategories[tableEntry['id']] = merged
+        tableEntry['categories'] = merged
+        yield tableEntry
+
+
+# --------------------------------- skip unchanged restaurants ---------------------------------
+
+# refuse to tombstone more than this share of the catalog in one run, a
+# crawl that comes back that small is more likely broken than real
+MAX_TOMBSTONE_FRACTION = 0.5
+
+def contentHash(tableEntry):
+    content = dict(tableEntry, categories=sorted(tableEntry['categories'], key=lambda category: category['alias']))
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def loadStoredHashes():
+    # id -> contentHash for live restaurants, id -> None for tombstoned ones
+    table = clients.get_table(RESTAURANT_TABLE)
+    scanArgs = {
+        'ProjectionExpression': '#id, contentHash, tombstoned',
+        'ExpressionAttributeNames': {'#id': 'id'}
+    }
+
+    storedHashes = {}
+    while True:
+        with metrics.span('dynamodb', 'scan'):
+            response = table.scan(**scanArgs)
+        for item in response['Items']:
+            storedHashes[item['id']] = None if item.get('tombstoned') else item.get('contentHash', '')
+        if 'LastEvaluatedKey' not in response:
+            return storedHashes
+        scanArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def loadStoredHashesFor(businessIds):
+    # loadStoredHashes for the given ids only, so a fan-out worker reads
+    # what its shard touches instead of scanning the whole table
+    storedHashes = {}
+    for item in dynamo.batch_get(RESTAURANT_TABLE, businessIds, '#id, contentHash, tombstoned', {'#id': 'id'}):
+        storedHashes[item['id']] = None if item.get('tombstoned') else item.get('contentHash', '')
+    return storedHashes
+
+def forgetHashes(businessIds):
+    # The stored hash says both DynamoDB and Elasticsearch hold this content.
+    # When the document did not make it into Elasticsearch the hash goes, so
+    # the restaurant no longer looks unchanged.
+    table = clients.get_table(RESTAURANT_TABLE)
+    for businessId in businessIds:
+        try:
+            with metrics.span('dynamodb', 'update_item'):
+                table.update_item(
+                    Key = {'id': businessId},
+                    UpdateExpression = 'REMOVE contentHash',
+                    # the item itself may not have been written either
+                    ConditionExpression = 'attribute_exists(id)'
                 )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+def markChanged(entries, storedHashes, stats):
+    # yields (tableEntry, changed)
+    for tableEntry in entries:
+        tableEntry['contentHash'] = contentHash(tableEntry)
+        if storedHashes.get(tableEntry['id']) == tableEntry['contentHash']:
+            stats['unchanged'] += 1
+            yield tableEntry, False
+            continue
+        storedHashes[tableEntry['id']] = tableEntry['contentHash']
+        yield tableEntry, True
+
+def tombstoneRestaurants(businessIds, catalogSize, elasticSink):
+    if not businessIds:
+        return 0
+    if len(businessIds) > catalogSize * MAX_TOMBSTONE_FRACTION:
+        print(f'Not tombstoning {len(businessIds)} of {catalogSize} restaurants, the crawl looks incomplete')
+        return 0
+
+    # Keep the item so late readers still resolve it, but take it out of search
+    table = clients.get_table(RESTAURANT_TABLE)
+    now = str(datetime.datetime.now())
+    for businessId in businessIds:
+        with metrics.span('dynamodb', 'update_item'):
+            table.update_item(
+                Key = {'id': businessId},
+                UpdateExpression = 'SET tombstoned = :true, tombstonedAtTimestamp = :now REMOVE contentHash',
+                ExpressionAttributeValues = {':true': True, ':now': now}
+            )
+
+    elasticSink.remove(businessIds)
+    return len(businessIds)
+
+
+# --------------------------------- insert restaurant info to DynamoDB ---------------------------------
+
+RESTAURANT_TABLE = 'YelpRestaurant'
+BATCH_WRITE_LIMIT = 25  # maximum items per BatchWriteItem request
+BATCH_WRITE_MAX_ATTEMPTS = 6
+BATCH_WRITE_BASE_DELAY = 0.1
+
+def tableItem(tableEntry):
+    # Add necessary attributes to the yelp-restaurants table
+    return {
+        'insertedAtTimestamp': str(datetime.datetime.now()),
+        'id': tableEntry['id'],
+        'name': tableEntry['name'],
+        'address': tableEntry['address'],
+        'latitude': tableEntry.get('latitude', None),
+        'longitude': tableEntry.get('longitude', None),
+        'review_count': tableEntry['review_count'],
+        'rating': tableEntry['rating'],
+        'zip_code': tableEntry.get('zip_code', None),
+        'geohash': tableEntry.get('geohash', None),
+        'categories': tableEntry['categories'],
+        'contentHash': tableEntry['contentHash']
+    }
+
+def batchWrite(tableName, items):
+    # boto3's batch_writer resends UnprocessedItems immediately and never
+    # reports what it gave up on, so batch the writes here with backoff
+    from botocore.exceptions import ClientError
+
+    dynamodb = clients.get_resource('dynamodb')
+    written = 0
+    failed = 0
+
+    for i in range(0, len(items), BATCH_WRITE_LIMIT):
+        writeRequests = [{'PutRequest': {'Item': item}} for item in items[i:i + BATCH_WRITE_LIMIT]]
+
+        attempt = 0
+        while writeRequests:
+            try:
+                with metrics.span('dynamodb', 'batch_write_item'):
+                    response = dynamodb.batch_write_item(RequestItems={tableName: writeRequests})
+            except ClientError as e:
+                print(f'BatchWriteItem failed: {e}')
+                failed += len(writeRequests)
+                break
+
+            unprocessed = response.get('UnprocessedItems', {}).get(tableName, [])
+            written += len(writeRequests) - len(unprocessed)
+            writeRequests = unprocessed
+
+            if writeRequests:
+                attempt += 1
+                if attempt >= BATCH_WRITE_MAX_ATTEMPTS:
+                    failed += len(writeRequests)
+                    break
+                time.sleep(throttle.jittered_backoff(attempt, base=BATCH_WRITE_BASE_DELAY))
+
+    return written, failed
+
+class DynamoSink:
+    # Buffers entries and writes them one BatchWriteItem chunk at a time
+
+    def __init__(self, tableName):
+        self.tableName = tableName
+        self.buffer = []
+        self.written = 0
+        self.failed = 0
+        self.report = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, tableEntry):
+        self.buffer.append(tableItem(tableEntry))
+        if len(self.buffer) >= BATCH_WRITE_LIMIT:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        written, failed = batchWrite(self.tableName, self.buffer)
+        self.written += written
+        self.failed += failed
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.report = {
+            'written': self.written,
+            'failed': self.failed
+        }
+        print(json.dumps({'dynamodb': self.report}))
+        return self.report
 
 
 # --------------------------------- insert indicies to Elastic Search ---------------------------------
 
 # Add elastic search indices after DB has been added
 
-credentials = boto3.Session().get_credentials()
-region = 'us-east-1'
-service = 'es'
-awsauth = AWS4Auth(credentials.access_key, credentials.secret_key, region, service, session_token=credentials.token)
-
-def addElasticIndex(restaurants):
-    host = 'search-yelp-restaurant-jcwqo7mjstbw3yereil3vhezgy.us-east-1.es.amazonaws.com' 
-    
-    es = Elasticsearch(
-        hosts = [{'host': host, 'port': 443}],
-        http_auth = awsauth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection
-    )
-    
-    for search_block in restaurants:
-        for restaurant in search_block:
-        
-            index_data = {
-                'id': restaurant['id'],
-                'categories': restaurant['categories']
-            }                            
-
-            es.index(index="restaurants", doc_type="Restaurant", id=restaurant['id'], body=index_data, refresh=True)
\ No newline at end of file
+# Readers (LF2) query this alias, it points at one versioned index at a time
+ES_ALIAS = 'restaurants'
+# bump when INDEX_BODY changes, the next run then rebuilds into a new index
+MAPPING_VERSION = 2
+KEEP_PREVIOUS_INDICES = 1
+ES_DOC_TYPE = 'Restaurant'
+BULK_CHUNK_SIZE = 500
+BULK_MAX_CHUNK_BYTES = 5 * 1024 * 1024
+MAX_REPORTED_FAILURES = 20
+LOAD_REFRESH_INTERVAL = os.environ.get('LOAD_REFRESH_INTERVAL', '5s')
+
+# Categories are exact-match filters, so they are keywords rather than
+# analyzed text. The title keeps a text subfield for free-text search.
+# geohash holds every indexed prefix of the location's geohash (see geo.py).
+INDEX_BODY = {
+    'mappings': {
+        ES_DOC_TYPE: {
+            'dynamic': 'strict',
+            'properties': {
+                'id': {'type': 'keyword'},
+                'categories': {
+                    'properties': {
+                        'alias': {'type': 'keyword'},
+                        'title': {
+                            'type': 'keyword',
+                            'normalizer': 'lowercase_keyword',
+                            'fields': {'text': {'type': 'text'}}
+                        }
+                    }
+                },
+                'rating': {'type': 'float'},
+                'review_count': {'type': 'integer'},
+                'location': {'type': 'geo_point'},
+                'geohash': {'type': 'keyword'}
+            }
+        }
+    },
+    'settings': {
+        'analysis': {
+            'normalizer': {
+                'lowercase_keyword': {'type': 'custom', 'filter': ['lowercase']}
+            }
+        }
+    }
+}
+
+def indexPrefix():
+    return '%s-m%d-' % (ES_ALIAS, MAPPING_VERSION)
+
+def newIndexName():
+    return indexPrefix() + datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S')
+
+def aliasedIndices(es):
+    if not es.indices.exists_alias(name=ES_ALIAS):
+        return []
+    return list(es.indices.get_alias(name=ES_ALIAS).keys())
+
+def needsRebuild(es):
+    # no alias yet (the old implicitly mapped index) or an outdated mapping
+    indices = aliasedIndices(es)
+    return not indices or not all(index.startswith(indexPrefix()) for index in indices)
+
+def swapAlias(es, newIndex):
+    oldIndices = aliasedIndices(es)
+    actions = [{'remove': {'index': index, 'alias': ES_ALIAS}} for index in oldIndices]
+    if not oldIndices and es.indices.exists(index=ES_ALIAS):
+        # first rebuild, a concrete index still holds the alias name
+        actions.append({'remove_index': {'index': ES_ALIAS}})
+    actions.append({'add': {'index': newIndex, 'alias': ES_ALIAS}})
+
+    # one update_aliases call, so readers switch atomically
+    es.indices.update_aliases(body={'actions': actions})
+    print(json.dumps({'aliasSwap': {'alias': ES_ALIAS, 'from': oldIndices, 'to': newIndex}}))
+
+    # keep the most recent previous versions around for a rollback
+    versions = sorted(index for index in es.indices.get(index=ES_ALIAS + '-*').keys() if index != newIndex)
+    for index in versions[:max(0, len(versions) - KEEP_PREVIOUS_INDICES)]:
+        es.indices.delete(index=index)
+
+def serveRebuild(es, buildIndex, restaurants, seenBusinesses):
+    # Moves the alias to a finished rebuild, unless it is missing live
+    # restaurants: a short crawl is not allowed to tombstone what it did not
+    # see, so those are live but not in the new index. The rebuild is then
+    # dropped, and what the crawl saw is written again by the next one, since
+    # the served index did not get it. Returns why it was not served.
+    documents = es.count(index=buildIndex)['count']
+    if documents >= len(restaurants):
+        swapAlias(es, buildIndex)
+        return None
+
+    reason = f'{buildIndex} holds {documents} of {len(restaurants)} live restaurants'
+    print(f'Not serving the rebuild, {reason}')
+    es.indices.delete(index=buildIndex)
+    forgetHashes(seenBusinesses)
+    return reason
+
+def createIndex(es, index):
+    if not es.indices.exists(index=index):
+        es.indices.create(index=index, body=INDEX_BODY, params={'include_type_name': 'true'})
+
+def beginLoad(es, index, loadRefreshInterval):
+    # Refreshing after every document creates a segment per restaurant, so
+    # refresh on a relaxed interval during the load, which still makes the
+    # first records searchable within seconds. Returns the interval to restore.
+    refreshInterval = None
+    settings = es.indices.get_settings(index=index, name='index.refresh_interval')
+    # keyed by the concrete index, also when index is the alias
+    for indexSettings in settings.values():
+        refreshInterval = indexSettings.get('settings', {}).get('index', {}).get('refresh_interval')
+    es.indices.put_settings(index=index, body={'index': {'refresh_interval': loadRefreshInterval}})
+    return refreshInterval
+
+def endLoad(es, index, refreshInterval):
+    # None restores the index default
+    es.indices.put_settings(index=index, body={'index': {'refresh_interval': refreshInterval}})
+    es.indices.refresh(index=index)
+
+def elasticDocument(restaurant):
+    index_data = {
+        'id': restaurant['id'],
+        'categories': [{'alias': category['alias'], 'title': category['title']} for category in restaurant['categories']],
+        'rating': float(restaurant['rating']),
+        'review_count': restaurant['review_count']
+    }
+
+    if restaurant.get('latitude') and restaurant.get('longitude'):
+        index_data['location'] = {'lat': float(restaurant['latitude']), 'lon': float(restaurant['longitude'])}
+        index_data['geohash'] = geo.prefixes(float(restaurant['latitude']), float(restaurant['longitude']))
+
+    return index_data
+
+def elasticActions(restaurants, index):
+    for restaurant in restaurants:
+        yield {
+            '_index': index,
+            '_type': ES_DOC_TYPE,
+            '_id': restaurant['id'],
+            '_source': elasticDocument(restaurant)
+        }
+
+class ElasticSink:
+    # Buffers entries and bulk indexes them in size-bounded chunks
+
+    # A fan-out worker passes manageRefresh=False, the coordinator relaxed
+    # the refresh interval and the worker finishing the crawl refreshes once
+
+    def __init__(self, index, loadRefreshInterval=LOAD_REFRESH_INTERVAL, manageRefresh=True):
+        self.index = index
+        self.loadRefreshInterval = loadRefreshInterval
+        self.manageRefresh = manageRefresh
+        self.es = clients.get_elasticsearch()
+        self.buffer = []
+        self.indexed = 0
+        self.failures = []
+        self.refreshInterval = None
+        self.report = None
+
+    def __enter__(self):
+        createIndex(self.es, self.index)
+        if self.manageRefresh:
+            self.refreshInterval = beginLoad(self.es, self.index, self.loadRefreshInterval)
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, tableEntry):
+        self.buffer.append(tableEntry)
+        if len(self.buffer) >= BULK_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        from elasticsearch import helpers
+        with metrics.span('elasticsearch', 'bulk'):
+            results = list(helpers.streaming_bulk(
+                self.es,
+                elasticActions(self.buffer, self.index),
+                chunk_size = BULK_CHUNK_SIZE,
+                max_chunk_bytes = BULK_MAX_CHUNK_BYTES,
+                raise_on_error = False,
+                raise_on_exception = False))
+        for ok, item in results:
+            if ok:
+                self.indexed += 1
+            else:
+                self.failures.append(item)
+        self.buffer = []
+
+    def remove(self, businessIds):
+        from elasticsearch import helpers
+
+        self.flush()
+        actions = ({'_op_type': 'delete', '_index': self.index, '_type': ES_DOC_TYPE, '_id': businessId} for businessId in businessIds)
+        with metrics.span('elasticsearch', 'bulk'):
+            results = list(helpers.streaming_bulk(
+                self.es,
+                actions,
+                chunk_size = BULK_CHUNK_SIZE,
+                raise_on_error = False,
+                raise_on_exception = False))
+        for ok, item in results:
+            # a document that is already gone is fine
+            if not ok and item.get('delete', {}).get('status') != 404:
+                self.failures.append(item)
+
+    def failedIds(self):
+        # restaurants whose documents were not indexed, failed deletes are left out
+        return [item['index']['_id'] for item in self.failures if 'index' in item]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.manageRefresh:
+                endLoad(self.es, self.index, self.refreshInterval)
+
+        self.report = {
+            'indexed': self.indexed,
+            'failed': len(self.failures),
+            'failures': self.failures[:MAX_REPORTED_FAILURES]
+        }
+        print(json.dumps({'elasticsearch': self.report}, default=str))
+        return self.report
@@ -1,41 +1,95 @@
 import json
-import boto3
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import clients
+import metrics
 
+
+LEX_BOT = 'MyMyChatBot'
+BOT_ALIAS = 'mymyChatAlias'
+# users whose messages are sent to Lex at the same time
+LEX_CONCURRENCY = int(os.environ.get('LEX_CONCURRENCY', '8'))
+# Lets a message name its own Lex userId, for load tests that simulate many
+# users through one caller. Off by default: any caller could otherwise drive
+# someone else's dialog by naming its id.
+CLIENT_USER_IDS = os.environ.get('CLIENT_USER_IDS', 'false').lower() == 'true'
+
+HEADERS = {
+    'Access-Control-Allow-Headers' : 'Content-Type',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
+}
+
+
+def lex_reply(client, user_id, user_message):
+    with metrics.span('lex-runtime', 'post_text'):
+        response = client.post_text(
+            botName = LEX_BOT,
+            botAlias = BOT_ALIAS,
+            userId = user_id,
+            inputText = user_message
+        )
+
+    return {
+        'type' : 'unstructured',
+        'unstructured' : {
+            'id' : response['ResponseMetadata']['RequestId'],
+            'text': response['message'],
+            'timestamp' : response['ResponseMetadata']['HTTPHeaders']['date']
+        }
+    }
+
+def converse(client, user_id, user_messages, replies):
+    # Lex keeps one dialog per user, so a user's messages go one at a time
+    for position, user_message in user_messages:
+        replies[position] = lex_reply(client, user_id, user_message)
+
+def messages_by_user(messages, default_user_id):
+    # user id -> [(position in the request, text)], in request order. With
+    # CLIENT_USER_IDS a message may name its own userId, for clients
+    # batching several users.
+    conversations = OrderedDict()
+    for position, message in enumerate(messages):
+        unstructured = message['unstructured']
+        user_id = (CLIENT_USER_IDS and unstructured.get('userId')) or default_user_id
+        conversations.setdefault(user_id, []).append((position, unstructured['text']))
+    return conversations
+
+@metrics.handler('LF0')
 def lambda_handler(event, context):
-    client = boto3.client('lex-runtime')
-    
-    user_message = json.loads(event['body'])['messages'][0]['unstructured']['text']
-    user_id = event['requestContext']['accountId']
-    lex_bot = 'MyMyChatBot'
-    bot_alias = 'mymyChatAlias'
-        
-    response = client.post_text(
-        botName = lex_bot,
-        botAlias = bot_alias,
-        userId = user_id,
-        inputText = user_message
-    )   
-    
-    
+    client = clients.get_client('lex-runtime')
+
+    messages = json.loads(event['body']).get('messages') or []
+    if not messages:
+        return {
+            'statusCode': 400,
+            'headers': HEADERS,
+            'body': json.dumps({'code': 400, 'message': 'The request has no messages'})
+        }
+
+    conversations = messages_by_user(messages, event['requestContext']['accountId'])
+
+    replies = [None] * len(messages)
+    if len(conversations) == 1:
+        user_id, user_messages = next(iter(conversations.items()))
+        converse(client, user_id, user_messages, replies)
+    else:
+        # different users do not share dialog state, so they run side by side
+        with ThreadPoolExecutor(max_workers=min(LEX_CONCURRENCY, len(conversations))) as executor:
+            futures = [executor.submit(converse, client, user_id, user_messages, replies)
+                       for user_id, user_messages in conversations.items()]
+        for future in futures:
+            # the first failure fails the request, as a single message did
+            future.result()
+
     formatted_response = {
-            'messages' :  [{
-                'type' : 'unstructured',
-                'unstructured' : {
-                    'id' : response['ResponseMetadata']['RequestId'],
-                    'text': response['message'],
-                    'timestamp' : response['ResponseMetadata']['HTTPHeaders']['date']
-                }
-            }]
+            'messages' : replies
         }
-    
-    
+
     return {
         'statusCode': 200,
-        'headers': { 
-            'Access-Control-Allow-Headers' : 'Content-Type',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
-        },
+        'headers': HEADERS,
         'body': json.dumps(formatted_response)
-    }
\ No newline at end of file
+    }
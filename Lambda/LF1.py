@@ -1,15 +1,20 @@
+import hashlib
 import json
 import os
-import math
-import dateutil.parser
+import re
 import datetime
 import time
 import logging
-import boto3
+from collections import OrderedDict
+
+import clients
+import cuisines
+import geo
+import metrics
 
 
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 
 
 def get_slots(intent_request):
@@ -52,19 +57,6 @@ def elicit_slot(session_attributes, intent_name, slots, slot_to_elicit, message)
         }
     }
 
-def isvalid_date(date):
-    try:
-        dateutil.parser.parse(date)
-        return True
-    except ValueError:
-        return False
-
-def parse_int(n):
-    try:
-        return int(n)
-    except ValueError:
-        return float('nan')
-
 def delegate(session_attributes, slots):
     return {
         'sessionAttributes': session_attributes,
@@ -101,63 +93,100 @@ def ThankYouIntent(intent_request):
 
 # --------------------------------- perfom validation ---------------------------------
 
-def validateIntentSlots(location, cuisine, num_people, date, given_time, phone_num):
-
-    locations = ['new york', 'manhattan']
-    if location is not None and location.lower() not in locations:
-        return build_validation_result(False,
-                                      'location',
-                                      'Sorry! We do not serve recommendations for this location right now!')
-                                   
-    cuisines = ['korean', 'chinese', 'coffee', 'american', 'indian', 'japanese']
-    if cuisine is not None and cuisine.lower() not in cuisines:
-        return build_validation_result(False,
-                                      'cuisine',
-                                      'Sorry! We do not serve recommendations for this cuisine right now!')
-                                       
-    if num_people is not None:
-        num_people = int(num_people)
-        if num_people > 20 or num_people <= 0:
-            return build_validation_result(False,
-                                      'num_people',
-                                      'Sorry! Number of people should be at least 1 and at most 20!')
-    
-    if date:
-        # invalid date
-        if not isvalid_date(date):
-            return build_validation_result(False, 'date', 'I did not understand that, what date would you like to add?')
-        # user entered a date before today
-        elif datetime.datetime.strptime(date, '%Y-%m-%d').date() < datetime.date.today():
-            return build_validation_result(False, 'date', 'You can search restaurant from today onwards. What day would you like to search?')
-
-    if given_time:
-        hour, minute = given_time.split(':')
-        hour = parse_int(hour)
-        minute = parse_int(minute)
-        if math.isnan(hour) or math.isnan(minute):
-            # Not a valid time; use a prompt defined on the build-time model.
-            return build_validation_result(False, 'given_time', 'Not a valid time')
+# Validators are built once per container. Each one parses its slot a
+# single time and returns None when the value is fine, otherwise the
+# message to elicit the slot again with.
 
-    
-    if phone_num and len(phone_num) != 10:
-        return build_validation_result(
-            False,
-            'phone_num',
-            'Sorry, {} is not a valid phone number. Please provide a valid US phone number.'.format(phone_num)
-        )
-    
-    return build_validation_result(True, None, None)
+SERVED_LOCATIONS = frozenset(geo.LOCATIONS)
+SERVED_CUISINES = frozenset(cuisines.CUISINE_CATEGORIES)
+DATE_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+TIME_PATTERN = re.compile(r'(\d{1,2}):(\d{2})')
+PHONE_PATTERN = re.compile(r'\d{10}')
+NUMBER_PATTERN = re.compile(r'\d+')
+
+def validate_location(location):
+    if location.lower() not in SERVED_LOCATIONS:
+        return 'Sorry! We do not serve recommendations for this location right now!'
+
+def validate_cuisine(cuisine):
+    if cuisine.lower() not in SERVED_CUISINES:
+        return 'Sorry! We do not serve recommendations for this cuisine right now!'
+
+def validate_num_people(num_people):
+    if not NUMBER_PATTERN.fullmatch(num_people) or not 1 <= int(num_people) <= 20:
+        return 'Sorry! Number of people should be at least 1 and at most 20!'
+
+def validate_date(date):
+    # Lex resolves AMAZON.DATE slots to ISO dates
+    match = DATE_PATTERN.fullmatch(date)
+    try:
+        day = datetime.date(*map(int, match.groups())) if match else None
+    except ValueError:
+        day = None
+
+    if day is None:
+        return 'I did not understand that, what date would you like to add?'
+    # user entered a date before today
+    if day < datetime.date.today():
+        return 'You can search restaurant from today onwards. What day would you like to search?'
+
+def validate_time(given_time):
+    # AMAZON.TIME resolves vague times to MO, AF, EV or NI, which are not accepted
+    match = TIME_PATTERN.fullmatch(given_time)
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        return 'Not a valid time'
+
+def validate_phone_num(phone_num):
+    if not PHONE_PATTERN.fullmatch(phone_num):
+        return 'Sorry, {} is not a valid phone number. Please provide a valid US phone number.'.format(phone_num)
+
+# checked in this order, the first invalid slot is elicited again
+SLOT_VALIDATORS = (
+    ('location', validate_location),
+    ('cuisine', validate_cuisine),
+    ('num_people', validate_num_people),
+    ('date', validate_date),
+    ('given_time', validate_time),
+    ('phone_num', validate_phone_num)
+)
+
+# session attribute holding the slot values that already passed
+VALIDATED_SLOTS = 'validatedSlots'
+
+def validate_slots(slots, session_attributes):
+    # Lex sends every filled slot on every turn, so values that passed on an
+    # earlier turn today are not checked again (dates expire at midnight)
+    today = datetime.date.today().isoformat()
+    validated = json.loads(session_attributes.get(VALIDATED_SLOTS) or '{}')
+    if validated.get('_day') != today:
+        validated = {'_day': today}
+
+    result = build_validation_result(True, None, None)
+    for slot, validator in SLOT_VALIDATORS:
+        value = slots.get(slot)
+        if not value or validated.get(slot) == value:
+            continue
+
+        message = validator(value)
+        if message is not None:
+            result = build_validation_result(False, slot, message)
+            break
+        validated[slot] = value
+
+    session_attributes[VALIDATED_SLOTS] = json.dumps(validated)
+    return result
 
 
 # --------------------------------- validate input and send to SQS ---------------------------------
 
 def dining_suggestion_intent(intent_request):
-    location = get_slots(intent_request)["location"]
-    cuisine = get_slots(intent_request)["cuisine"]
-    num_people = get_slots(intent_request)["num_people"]
-    date = get_slots(intent_request)["date"]
-    given_time = get_slots(intent_request)["given_time"]
-    phone_num = get_slots(intent_request)["phone_num"]
+    slots = get_slots(intent_request)
+    location = slots["location"]
+    cuisine = slots["cuisine"]
+    num_people = slots["num_people"]
+    date = slots["date"]
+    given_time = slots["given_time"]
+    phone_num = slots["phone_num"]
     session_attributes = intent_request['sessionAttributes'] if intent_request['sessionAttributes'] is not None else {}
 
     requestData = {
@@ -169,30 +198,29 @@ def dining_suggestion_intent(intent_request):
                     "phoneNum": phone_num
                 }
                 
-    print (requestData)
+    logger.debug(requestData)
 
     session_attributes['requestData'] = json.dumps(requestData)
     
 
     if intent_request['invocationSource'] == 'DialogCodeHook':
-        slots = get_slots(intent_request)
-        
         # validate inputs
-        validation_result = validateIntentSlots(location, cuisine, num_people, date, given_time, phone_num)
+        validation_result = validate_slots(slots, session_attributes)
         
         # If validation fails, elicit the slot again 
         if not validation_result['isValid']:
             slots[validation_result['violatedSlot']] = None
-            print ("elicit slot")
+            logger.debug("elicit slot")
             return elicit_slot(session_attributes,
                               intent_request['currentIntent']['name'],
                               slots,
                               validation_result['violatedSlot'],
                               validation_result['message'])
-        return delegate(session_attributes, intent_request['currentIntent']['slots'])
+        return delegate(session_attributes, slots)
     
-    messageId = sendSQSMessage(requestData)
-    print (messageId)
+    # Lex retries and repeated requests collapse into one queued message
+    messageId = sendSQSMessage(requestData, fulfillment_key(intent_request, requestData))
+    logger.info('Queued %s', messageId)
 
     return close(intent_request['sessionAttributes'],
              'Fulfilled',
@@ -200,12 +228,98 @@ def dining_suggestion_intent(intent_request):
               'content': 'Got all the data, You will receive recommendation soon.'})
 
 
+# --------------------------------- deduplicate fulfillments ---------------------------------
+
+QUEUE_URL = os.environ.get('QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/380014966022/restaurantQueue')
+# identical requests of a user within this many seconds are queued once
+# (a FIFO queue always deduplicates over 5 minutes)
+DEDUP_WINDOW_SECONDS = int(os.environ.get('DEDUP_WINDOW_SECONDS', '300'))
+# table with partition key 'id' and TTL on 'expiresAt', used for standard queues
+DEDUP_TABLE = os.environ.get('DEDUP_TABLE', 'DiningRequestDedup')
+DEDUP_CACHE_SIZE = 1024
+
+def is_fifo_queue():
+    return QUEUE_URL.endswith('.fifo')
+
+def fulfillment_key(intent_request, requestData):
+    # same user asking for the same thing, however the slots were capitalized
+    content = {
+        'user': intent_request.get('userId'),
+        'request': {name: (value or '').strip().lower() for name, value in requestData.items()}
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+class RecentFulfillments:
+    # Keys claimed by this container, so retries that land on the same warm
+    # container skip the DynamoDB round-trip
+
+    def __init__(self, window=DEDUP_WINDOW_SECONDS, maxsize=DEDUP_CACHE_SIZE):
+        self.window = window
+        self.maxsize = maxsize
+        self._expires = OrderedDict()
+
+    def __contains__(self, key):
+        self._expire(time.time())
+        return key in self._expires
+
+    def add(self, key):
+        now = time.time()
+        self._expire(now)
+        self._expires[key] = now + self.window
+        self._expires.move_to_end(key)
+        while len(self._expires) > self.maxsize:
+            self._expires.popitem(last=False)
+
+    def discard(self, key):
+        self._expires.pop(key, None)
+
+    def _expire(self, now):
+        # every entry lives for the same window, so the oldest expire first
+        while self._expires and next(iter(self._expires.values())) <= now:
+            self._expires.popitem(last=False)
+
+recent_fulfillments = RecentFulfillments()
+
+def claim_fulfillment(key):
+    # True when this is the first fulfillment of key within the window
+    if key in recent_fulfillments:
+        return False
+
+    table = clients.get_table(DEDUP_TABLE)
+    now = int(time.time())
+    try:
+        # DynamoDB deletes expired items lazily, so the condition checks the expiry too
+        with metrics.span('dynamodb', 'put_item'):
+            table.put_item(
+                Item = {'id': key, 'expiresAt': now + DEDUP_WINDOW_SECONDS},
+                ConditionExpression = 'attribute_not_exists(id) OR expiresAt <= :now',
+                ExpressionAttributeValues = {':now': now}
+            )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        recent_fulfillments.add(key)
+        return False
+    except Exception as e:
+        # a duplicate SMS beats a lost request
+        logger.warning('Failed to record fulfillment %s: %s', key, e)
+
+    recent_fulfillments.add(key)
+    return True
+
+def release_fulfillment(key):
+    # the message was not queued, let a retry through
+    recent_fulfillments.discard(key)
+    try:
+        with metrics.span('dynamodb', 'delete_item'):
+            clients.get_table(DEDUP_TABLE).delete_item(Key={'id': key})
+    except Exception as e:
+        logger.warning('Failed to release fulfillment %s: %s', key, e)
+
+
 # --------------------------------- send info to SQS ---------------------------------
 
-def sendSQSMessage(requestData):
+def sendSQSMessage(requestData, dedupKey):
     
-    sqs = boto3.client('sqs')
-    queue_url = 'https://sqs.us-east-1.amazonaws.com/380014966022/restaurantQueue'
+    sqs = clients.get_client('sqs')
     
     messageAttributes = {
         'Cuisine': {
@@ -235,15 +349,35 @@ def sendSQSMessage(requestData):
     }
     
     messageBody=('Slots for the Restaurant')
-    print (messageBody)
     
-    response = sqs.send_message(
-        QueueUrl = queue_url,
-        DelaySeconds = 2,
-        MessageAttributes = messageAttributes,
-        MessageBody = messageBody
-        )
-    print (response)
+    if is_fifo_queue():
+        # SQS drops repeats of the deduplication id itself. FIFO queues take
+        # no per-message delay; one group per request keeps them parallel.
+        with metrics.span('sqs', 'send_message'):
+            response = sqs.send_message(
+                QueueUrl = QUEUE_URL,
+                MessageAttributes = messageAttributes,
+                MessageBody = messageBody,
+                MessageDeduplicationId = dedupKey,
+                MessageGroupId = dedupKey
+                )
+        return response['MessageId']
+
+    if not claim_fulfillment(dedupKey):
+        logger.info('Duplicate fulfillment %s, not queued again', dedupKey)
+        return None
+
+    try:
+        with metrics.span('sqs', 'send_message'):
+            response = sqs.send_message(
+                QueueUrl = QUEUE_URL,
+                DelaySeconds = 2,
+                MessageAttributes = messageAttributes,
+                MessageBody = messageBody
+                )
+    except Exception:
+        release_fulfillment(dedupKey)
+        raise
     
     return response['MessageId']
     
@@ -266,6 +400,7 @@ def dispatch(intent_request):
 
 # --------------------------------- MAIN ---------------------------------
 
+@metrics.handler('LF1')
 def lambda_handler(event, context):
     os.environ['TZ'] = 'America/New_York'
     time.tzset()
@@ -1,85 +1,132 @@
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
-import json
-from random import randint
-import requests
-from requests_aws4auth import AWS4Auth
-from elasticsearch import Elasticsearch, RequestsHttpConnection
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from random import Random, randint
 
+import clients
+import cuisines
+import dynamo
+import geo
+import metrics
+import snapshot
+import throttle
 
-QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/380014966022/restaurantQueue'
+# numpy and ranking (which needs numpy) are imported where they are used,
+# so cold starts that never rank, such as an empty poll, do not load them
+
+
+QUEUE_URL = os.environ.get('QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/380014966022/restaurantQueue')
 
 
 # --------------------------------- decipher message from SQS ---------------------------------
 
-def dequeue():
-    sqs = boto3.client('sqs', region_name='us-east-1')
-    
-    sqs_response = sqs.receive_message(
-    QueueUrl = QUEUE_URL,
-    AttributeNames=[
-        'SentTimestamp'
-    ],
-    MaxNumberOfMessages=1,
-    MessageAttributeNames=[
-        'All'
-    ],
-    VisibilityTimeout = 0,
-    WaitTimeSeconds = 0
-    )
-    
-    if 'Messages' in sqs_response:
-        message = sqs_response['Messages'][0]
-        res_location = message['MessageAttributes']['Location']['StringValue']
-        res_cuisine = message['MessageAttributes']['Cuisine']['StringValue']
-        res_date = message['MessageAttributes']['DiningDate']['StringValue']
-        res_time = message['MessageAttributes']['DiningTime']['StringValue']
-        res_people = message['MessageAttributes']['PeopleNum']['StringValue']
-        res_number = message['MessageAttributes']['PhoneNum']['StringValue']
-    
-        # delete message after usage
-        receipt_handle = sqs_response['Messages'][0]['ReceiptHandle']
-        sqs.delete_message(
+# Messages received per poll when running in polling mode (SQS caps this at 10)
+POLL_BATCH_SIZE = int(os.environ.get('POLL_BATCH_SIZE', '10'))
+POLL_WAIT_SECONDS = int(os.environ.get('POLL_WAIT_SECONDS', '1'))
+
+def parse_message(message):
+    # Polled messages use 'MessageAttributes'/'StringValue' while event source
+    # records use 'messageAttributes'/'stringValue'
+    attributes = message.get('MessageAttributes') or message.get('messageAttributes') or {}
+
+    def attribute_value(name):
+        attribute = attributes[name]
+        return attribute.get('StringValue', attribute.get('stringValue'))
+
+    return {
+        'location': attribute_value('Location'),
+        'cuisine': attribute_value('Cuisine'),
+        'date': attribute_value('DiningDate'),
+        'time': attribute_value('DiningTime'),
+        'people': attribute_value('PeopleNum'),
+        'number': attribute_value('PhoneNum')
+    }
+
+def dequeue(sqs):
+    with metrics.span('sqs', 'receive_message'):
+        sqs_response = sqs.receive_message(
             QueueUrl = QUEUE_URL,
-            ReceiptHandle = receipt_handle
+            AttributeNames=[
+                'SentTimestamp'
+            ],
+            MaxNumberOfMessages = POLL_BATCH_SIZE,
+            MessageAttributeNames=[
+                'All'
+            ],
+            WaitTimeSeconds = POLL_WAIT_SECONDS
         )
-    else:
-        return ['Error while retrieving message from SQS!']
-        
-    info = []
-    info.append(res_location)
-    info.append(res_cuisine)
-    info.append(res_date)
-    info.append(res_time)
-    info.append(res_people)
-    info.append(res_number)
-    return info
+
+    return sqs_response.get('Messages', [])
+
+def delete_messages(sqs, messages):
+    # delete only after the recommendation has been sent, so failed messages
+    # become visible again once their visibility timeout expires
+    if not messages:
+        return
+
+    with metrics.span('sqs', 'delete_message_batch'):
+        response = sqs.delete_message_batch(
+            QueueUrl = QUEUE_URL,
+            Entries = [{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(messages)]
+        )
+    for failure in response.get('Failed', []):
+        print(f"Failed to delete message {failure['Id']}: {failure.get('Message')}")
 
 
 # --------------------------------- perform elastic search with cuisine keyword from SQS ---------------------------------
 
-credentials = boto3.Session().get_credentials()
-region = 'us-east-1'
-service = 'es'
-awsauth = AWS4Auth(credentials.access_key, credentials.secret_key, region, service, session_token=credentials.token)
+# alias maintained by LF-Yelp over the current versioned index
+ES_INDEX = 'restaurants'
+RECOMMENDATION_COUNT = 3
+# 'cached' draws from a cached candidate pool, 'random' samples server side,
+# 'relevance' is the original slice of the top hits
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'cached')
 
-def rand_elastic_search(location, cuisine):
-    es_endpoint = 'search-yelp-restaurant-jcwqo7mjstbw3yereil3vhezgy.us-east-1.es.amazonaws.com' 
-    
-    es = Elasticsearch(
-        hosts = [{'host': es_endpoint, 'port': 443}],
-        http_auth = awsauth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection
-    )
+def rand_elastic_search(location, cuisine, seed=None):
+    if SEARCH_MODE == 'relevance':
+        return relevance_elastic_search(location, cuisine)
+    if SEARCH_MODE == 'cached' and CANDIDATE_CACHE_SIZE > 0:
+        return cached_candidate_search(location, cuisine, seed)
+
+    es = clients.get_elasticsearch()
+    if seed is None:
+        seed = randint(0, 2 ** 31 - 1)
+
+    # The cuisine and location are filters (no scoring, cached by
+    # Elasticsearch) and random_score gives every match the same chance, so
+    # the whole category is sampled while only RECOMMENDATION_COUNT ids come back
+    filters = search_filters(location, cuisine)
+    with metrics.span('elasticsearch', 'search'):
+        search_data = es.search(index=ES_INDEX, body={
+            "size": RECOMMENDATION_COUNT,
+            "_source": ["id"],
+            "query": {
+                "function_score": {
+                    "query": {
+                        "bool": {
+                            "filter": filters}},
+                    "random_score": {"seed": seed, "field": "_seq_no"},
+                    "boost_mode": "replace"
+                }}})
+
+    rand_business_ids = [hit['_source']['id'] for hit in search_data['hits']['hits']]
+    if not rand_business_ids:
+        return [f'Sorry! We do not have any data for {cuisine} in {location}.']
+
+    return rand_business_ids
+
+def relevance_elastic_search(location, cuisine):
+    es = clients.get_elasticsearch()
 
     # Get the food category from queue message attributes.
-    search_data = es.search(index="restaurants", body={
-        "query": {
-            "match": {
-                "categories.title": cuisine
-            }}})
+    with metrics.span('elasticsearch', 'search'):
+        search_data = es.search(index=ES_INDEX, body={
+            "query": {
+                "match": {
+                    "categories.title.text": cuisine
+                }}})
             
     
     # Choose random among returned list
@@ -90,7 +137,7 @@ def rand_elastic_search(location, cuisine):
     rand_idx = randint(0,total_num_searches - 1)
     
     rand_business_ids = []
-    while len(rand_business_ids) < 3:
+    while len(rand_business_ids) < RECOMMENDATION_COUNT:
         rand_business_ids.append(search_data['hits']['hits'][rand_idx]['_source']['id'])
         rand_idx += 1
         if rand_idx >= total_num_searches:
@@ -99,77 +146,698 @@ def rand_elastic_search(location, cuisine):
     return rand_business_ids
 
 
+# --------------------------------- ingest generation published by LF-Yelp ---------------------------------
+
+# how often the ingest generation published by LF-Yelp is re-read
+GENERATION_CHECK_INTERVAL = float(os.environ.get('GENERATION_CHECK_INTERVAL', '60'))
+STATE_TABLE = 'YelpIngestState'
+GENERATION_ID = 'ingest-generation'
+
+class IngestGeneration:
+    # Latest generation number LF-Yelp published, re-read at most every
+    # GENERATION_CHECK_INTERVAL seconds. None until it could be read.
+
+    def __init__(self, interval=GENERATION_CHECK_INTERVAL):
+        self.interval = interval
+        self.value = None
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def current(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.interval:
+                return self.value
+            self._checked_at = now
+
+        try:
+            with metrics.span('dynamodb', 'get_item'):
+                response = clients.get_table(STATE_TABLE).get_item(Key={'id': GENERATION_ID})
+        except Exception as e:
+            # stale data beats failed recommendations
+            print(f'Failed to read the ingest generation: {e}')
+            return self.value
+
+        generation = response.get('Item', {}).get('generation')
+        with self._lock:
+            if generation is not None:
+                self.value = int(generation)
+            return self.value
+
+ingest_generation = IngestGeneration()
+
+
+# --------------------------------- location to geohash cells ---------------------------------
+
+LOCATION_INDEX_ID = 'location-cells'
+
+class LocationIndex:
+    # Cells of each served location that hold restaurants, published by
+    # LF-Yelp next to the ingest generation and re-read when it moves.
+
+    def __init__(self):
+        self.locations = None
+        self.generation = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def cells(self, location):
+        # cells of a location, None when the index does not know it
+        generation = ingest_generation.current()
+        with self._lock:
+            if not self._loaded or generation != self.generation:
+                self._loaded = True
+                self.generation = generation
+                self._load()
+            locations = self.locations
+
+        if locations is None or not location:
+            return None
+        return locations.get(location.lower())
+
+    def _load(self):
+        try:
+            with metrics.span('dynamodb', 'get_item'):
+                response = clients.get_table(STATE_TABLE).get_item(Key={'id': LOCATION_INDEX_ID})
+        except Exception as e:
+            print(f'Failed to read the location index: {e}')
+            return
+        self.locations = response.get('Item', {}).get('locations')
+
+location_index = LocationIndex()
+
+def location_filter(location):
+    # Only the cells of the location are searched, so a request costs the
+    # same however many locations and restaurants the index holds
+    cells = location_index.cells(location)
+    if cells is not None:
+        return {"terms": {"geohash": cells}}
+
+    # before LF-Yelp has published the index, or for a location it does not cover yet
+    bounds = geo.LOCATIONS.get(location.lower()) if location else None
+    if bounds is not None:
+        south, west, north, east = bounds
+        return {"geo_bounding_box": {"location": {
+            "top_left": {"lat": north, "lon": west},
+            "bottom_right": {"lat": south, "lon": east}}}}
+    return None
+
+def search_filters(location, cuisine):
+    filters = [{"terms": {"categories.alias": cuisines.category_aliases(cuisine)}}]
+    location_clause = location_filter(location)
+    if location_clause is not None:
+        filters.append(location_clause)
+    return filters
+
+
+# --------------------------------- cached candidate pools ---------------------------------
+
+CANDIDATE_CACHE_SIZE = int(os.environ.get('CANDIDATE_CACHE_SIZE', '64'))
+CANDIDATE_CACHE_TTL = float(os.environ.get('CANDIDATE_CACHE_TTL', '900'))
+CANDIDATE_PAGE_SIZE = 1000
+# a pool stops growing here, which is logged, as is any pool that reaches it
+MAX_CANDIDATES = int(os.environ.get('MAX_CANDIDATES', '20000'))
+
+class CandidatePoolCache:
+    # LRU cache of candidate id lists with a TTL, shared by the pipeline
+    # threads of a warm container. Everything is dropped when LF-Yelp
+    # publishes a new ingest generation.
+
+    def __init__(self, maxsize=CANDIDATE_CACHE_SIZE, ttl=CANDIDATE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = None
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key, loader):
+        self._check_generation()
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                loaded_at, candidates = entry
+                if now - loaded_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return candidates
+                del self._entries[key]
+                self.stats['expired'] += 1
+            self.stats['misses'] += 1
+
+        # load outside the lock, other keys stay served meanwhile
+        candidates = loader()
+
+        with self._lock:
+            self._entries[key] = (time.monotonic(), candidates)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+        return candidates
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _check_generation(self):
+        generation = ingest_generation.current()
+
+        with self._lock:
+            if generation != self.generation:
+                if self.generation is not None:
+                    self._entries.clear()
+                    self.stats['invalidations'] += 1
+                self.generation = generation
+
+candidate_cache = CandidatePoolCache()
+
+class CandidatePool:
+    # Candidate ids plus the columns the ranking scores, aligned by position
+
+    def __init__(self, sources):
+        import numpy as np
+
+        self.ids = [source['id'] for source in sources]
+        self.rating = np.array([source.get('rating') or 0 for source in sources], dtype=np.float32)
+        self.review_count = np.array([source.get('review_count') or 0 for source in sources], dtype=np.float32)
+        self.latitude = np.array([source.get('location', {}).get('lat', np.nan) for source in sources], dtype=np.float32)
+        self.longitude = np.array([source.get('location', {}).get('lon', np.nan) for source in sources], dtype=np.float32)
+
+def fetch_candidate_pool(location, cuisine):
+    es = clients.get_elasticsearch()
+
+    # filter only and unscored, paged by id so the ranking sees the whole pool
+    filters = search_filters(location, cuisine)
+    body = {
+        "size": CANDIDATE_PAGE_SIZE,
+        "_source": ["id", "rating", "review_count", "location"],
+        "sort": [{"id": "asc"}],
+        "query": {
+            "bool": {
+                "filter": filters}}}
+
+    sources = []
+    while True:
+        with metrics.span('elasticsearch', 'search'):
+            hits = es.search(index=ES_INDEX, body=body)['hits']['hits']
+        sources.extend(hit['_source'] for hit in hits)
+        if len(hits) < CANDIDATE_PAGE_SIZE:
+            break
+        if len(sources) >= MAX_CANDIDATES:
+            print(f'Candidate pool for {cuisine} in {location} truncated at {len(sources)} restaurants')
+            break
+        body['search_after'] = hits[-1]['sort']
+
+    return CandidatePool(sources)
+
+def cached_candidate_search(location, cuisine, seed=None):
+    key = (cuisine.lower(), location.lower())
+    pool = candidate_cache.get(key, lambda: fetch_candidate_pool(location, cuisine))
+    if not pool.ids:
+        return [f'Sorry! We do not have any data for {cuisine} in {location}.']
+
+    picks = pick_candidates(pool.rating, pool.review_count, pool.latitude, pool.longitude, location, seed)
+    return [pool.ids[pick] for pick in picks]
+
+
+# --------------------------------- rank candidates ---------------------------------
+
+# 'weighted' scores rating, review count and distance (see ranking.py),
+# 'uniform' picks any candidate with the same chance
+RANKING = os.environ.get('RANKING', 'weighted')
+
+def pick_candidates(rating, review_count, latitude, longitude, location, seed=None):
+    # positions of the recommended candidates
+    if RANKING == 'weighted':
+        import ranking
+        return ranking.rank_and_sample(rating, review_count, latitude, longitude, RECOMMENDATION_COUNT, location, seed).tolist()
+    return Random(seed).sample(range(len(rating)), min(RECOMMENDATION_COUNT, len(rating)))
+
+
+# --------------------------------- local restaurant snapshot ---------------------------------
+
+# Written by LF-Yelp after each full ingest, see snapshot.py
+SNAPSHOT_BUCKET = os.environ.get('SNAPSHOT_BUCKET')
+SNAPSHOT_KEY = os.environ.get('SNAPSHOT_KEY', 'snapshots/restaurants.snapshot')
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', '/tmp/restaurants.snapshot')
+# trusted without a readable ingest generation for this long
+SNAPSHOT_MAX_AGE = float(os.environ.get('SNAPSHOT_MAX_AGE', '86400'))
+
+class SnapshotStore:
+    # Downloads the snapshot into /tmp once per container and keeps it
+    # mapped. It is refreshed when LF-Yelp publishes a newer generation.
+
+    def __init__(self):
+        self.snapshot = None
+        self._attempted_generation = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        # the snapshot when it is current, None to fall back to the live services
+        if not SNAPSHOT_BUCKET:
+            return None
+
+        generation = ingest_generation.current()
+        with self._lock:
+            if self._needs_download(generation):
+                self._attempted_generation = generation
+                self._download()
+
+            current = self.snapshot
+        if current is None:
+            return None
+        # A snapshot of the published generation is current however old it
+        # is, LF-Yelp only writes a new one when the catalog changes. Age
+        # only matters while the generation could not be read.
+        if generation is None:
+            return current if current.age() <= SNAPSHOT_MAX_AGE else None
+        return current if current.generation == generation else None
+
+    def _needs_download(self, generation):
+        if self.snapshot is None:
+            return self._attempted_generation is None or generation != self._attempted_generation
+        # one attempt per generation, S3 may still hold the previous snapshot
+        return generation is not None and generation != self.snapshot.generation and generation != self._attempted_generation
+
+    def _download(self):
+        try:
+            partial = SNAPSHOT_PATH + '.download'
+            with metrics.span('s3', 'download_file'):
+                clients.get_client('s3').download_file(SNAPSHOT_BUCKET, SNAPSHOT_KEY, partial)
+            os.replace(partial, SNAPSHOT_PATH)
+            # views handed out earlier keep the previous mapping alive
+            self.snapshot = snapshot.Snapshot(SNAPSHOT_PATH)
+        except Exception as e:
+            print(f'Failed to load the restaurant snapshot: {e}')
+
+snapshot_store = SnapshotStore()
+
+def snapshot_members(current, location, cuisine):
+    # record numbers of the cuisine inside the cells of the location
+    import numpy as np
+
+    cells = location_index.cells(location)
+    if cells is None:
+        return np.asarray(current.members(cuisine), dtype=np.uint32)
+
+    groups = [np.asarray(current.members(snapshot.group(cuisine, cell)), dtype=np.uint32) for cell in cells]
+    if not groups:
+        return np.empty(0, dtype=np.uint32)
+    return np.concatenate(groups)
+
+def snapshot_recommendations(location, cuisine, seed=None):
+    # (name, address, review_count, rating) per pick, or None without a usable snapshot
+    current = snapshot_store.get()
+    if current is None:
+        return None
+
+    members = snapshot_members(current, location, cuisine.lower())
+    table = current.table()
+    picks = pick_candidates(
+        table['rating'][members],
+        table['review_count'][members],
+        table['latitude'][members],
+        table['longitude'][members],
+        location,
+        seed
+    )
+
+    restaurants = []
+    for pick in picks:
+        record = current.record(int(members[pick]))
+        restaurants.append((record['name'], record['address'], record['review_count'], record['rating']))
+    return restaurants
+
+
 # --------------------------------- search DynamoDB to get restaurant info ---------------------------------
 
-def dynamodb_search(rand_business_id):
-    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-    table_db = dynamodb.Table('YelpRestaurant')
-    
-    scanresult = table_db.query(KeyConditionExpression=Key('id').eq(rand_business_id))
-    item = scanresult['Items'][0]
-
-    name = item['name']
-    address_list = item['address']
-    address_list.pop() #take out "New York, NY, zipcode"
-    address = ", ".join(address_list)
-    review_count = item['review_count']
-    rating = item['rating']
-    
-    return (name, address, review_count, rating)
+RESTAURANT_TABLE = 'YelpRestaurant'
+def unique_ids(business_ids):
+    # rand_elastic_search wraps around short hit lists, so the same id can repeat
+    return list(dict.fromkeys(business_ids))
+
+def dynamodb_batch_search(business_ids):
+    # only what the SMS needs, 'categories' and the rest stay in the table
+    items = dynamo.batch_get(
+        RESTAURANT_TABLE,
+        business_ids,
+        '#id, #name, #address, #rating, #review_count',
+        {'#id': 'id', '#name': 'name', '#address': 'address', '#rating': 'rating', '#review_count': 'review_count'}
+    )
+
+    restaurants = {}
+    for item in items:
+        business_id = item['id']
+        address_list = item['address'][:-1] #take out "New York, NY, zipcode"
+        restaurants[business_id] = (item['name'], ", ".join(address_list), item['review_count'], item['rating'])
+
+    return restaurants
 
 
 # --------------------------------- send text message about the resturants ---------------------------------
 
+# SNS accepts a limited number of SMS per second per account, so publishes
+# from one container are paced by a token bucket and throttled ones retried
+SMS_RATE = float(os.environ.get('SMS_RATE', '20'))
+SMS_CONCURRENCY = int(os.environ.get('SMS_CONCURRENCY', '4'))
+SMS_MAX_ATTEMPTS = int(os.environ.get('SMS_MAX_ATTEMPTS', '5'))
+SMS_BASE_DELAY = 0.2
+# recommendations for one number are joined while the SMS stays within this many segments
+SMS_MAX_SEGMENTS = int(os.environ.get('SMS_MAX_SEGMENTS', '6'))
+SMS_SEPARATOR = '\n\n'
+# Throttled is what SNS returns for ThrottledException (HTTP 429), and botocore does not retry it
+THROTTLING_CODES = frozenset(['Throttled', 'Throttling', 'ThrottlingException', 'ThrottledException'])
+
+# GSM 03.38 characters, the extension table ones take two septets
+GSM7_BASIC = frozenset('@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+                       '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM7_EXTENDED = frozenset('^{}\\[~]|€\f')
+
+# shared by every batch a warm container handles
+sms_rate_limit = throttle.TokenBucket(SMS_RATE)
+
+def sms_segments(text):
+    # GSM-7 fits 160 characters in one segment and 153 per segment once
+    # split, anything else goes as UCS-2 with 70 and 67
+    septets = 0
+    for char in text:
+        if char in GSM7_BASIC:
+            septets += 1
+        elif char in GSM7_EXTENDED:
+            septets += 2
+        else:
+            units = len(text.encode('utf-16-le')) // 2
+            return 1 if units <= 70 else -(-units // 67)
+    return 1 if septets <= 160 else -(-septets // 153)
+
+def is_throttling(error):
+    # botocore ClientError, read without importing botocore
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in THROTTLING_CODES
+
 def sendsns(message, number):
-    sns = boto3.client('sns', region_name='us-east-1')
-    response = sns.publish(
-        PhoneNumber = number,
-        Message = message,
-        MessageStructure = 'string',
-        MessageAttributes = {
-            'AWS.SNS.SMS.SMSType': {
-                'DataType': 'String',
-                'StringValue': 'Transactional'
+    sns = clients.get_client('sns')
+    with metrics.span('sns', 'publish'):
+        response = sns.publish(
+            PhoneNumber = number,
+            Message = message,
+            MessageStructure = 'string',
+            MessageAttributes = {
+                'AWS.SNS.SMS.SMSType': {
+                    'DataType': 'String',
+                    'StringValue': 'Transactional'
+                }
             }
+        )
+
+    return response['MessageId']
+
+def coalesce_messages(messages, max_segments=SMS_MAX_SEGMENTS):
+    # (number, text) pairs -> number -> [(text, [positions])]. Messages for
+    # the same number are joined in order while the SMS fits max_segments.
+    outgoing = OrderedDict()
+    for position, (number, text) in enumerate(messages):
+        texts = outgoing.setdefault(number, [])
+        if texts:
+            joined = texts[-1][0] + SMS_SEPARATOR + text
+            if sms_segments(joined) <= max_segments:
+                texts[-1] = (joined, texts[-1][1] + [position])
+                continue
+        texts.append((text, [position]))
+    return outgoing
+
+class SmsDispatcher:
+    # Sends the messages of a batch, one SMS per number where they fit.
+    # Numbers are served side by side up to `concurrency`, the SMS of one
+    # number go out in order.
+
+    def __init__(self, rate_limit=None, concurrency=SMS_CONCURRENCY, max_attempts=SMS_MAX_ATTEMPTS):
+        # the container's bucket, looked up now so it can be replaced
+        self.rate_limit = rate_limit if rate_limit is not None else sms_rate_limit
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()
+        self.stats = {'messages': 0, 'sms': 0, 'throttled': 0, 'failed': 0}
+
+    def dispatch(self, messages):
+        # Returns one entry per (number, text): None once SNS accepted its SMS,
+        # the raised exception otherwise
+        errors = [None] * len(messages)
+        outgoing = coalesce_messages(messages)
+        self.stats['messages'] += len(messages)
+
+        if len(outgoing) <= 1 or self.concurrency == 1:
+            for number, texts in outgoing.items():
+                self._send_all(number, texts, errors)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(outgoing))) as executor:
+                for number, texts in outgoing.items():
+                    executor.submit(self._send_all, number, texts, errors)
+        return errors
+
+    def _send_all(self, number, texts, errors):
+        for text, positions in texts:
+            try:
+                self.publish(number, text)
+            except Exception as e:
+                with self._lock:
+                    self.stats['failed'] += 1
+                for position in positions:
+                    errors[position] = e
+
+    def publish(self, number, text):
+        for attempt in range(self.max_attempts):
+            self.rate_limit.acquire()
+            try:
+                message_id = sendsns(text, number)
+            except Exception as e:
+                if not is_throttling(e) or attempt + 1 == self.max_attempts:
+                    raise
+                with self._lock:
+                    self.stats['throttled'] += 1
+                time.sleep(throttle.jittered_backoff(attempt, base=SMS_BASE_DELAY))
+                continue
+
+            with self._lock:
+                self.stats['sms'] += 1
+            return message_id
+
+
+# --------------------------------- recommendation stages ---------------------------------
+
+def search_stage(request):
+    # Served from the local snapshot when it is current
+    restaurants = snapshot_recommendations(request['location'], request['cuisine'])
+    if restaurants is not None:
+        request['restaurants'] = restaurants
+        return request
+
+    # Choose a random restaurant with the given cuisine
+    request['business_ids'] = rand_elastic_search(request['location'], request['cuisine'])
+    return request
+
+def recommendation_message(request, restaurants):
+    message_per_rest = []
+    for name, address, review_count, rating in restaurants:
+        message_per_rest.append(f'{len(message_per_rest) + 1}. {name}, located at {address}')
+
+    if not message_per_rest:
+        return f"Sorry! We do not have any data for {request['cuisine']} in {request['location']}."
+
+    rest_message = ", ".join(message_per_rest)
+    return f"Hello! Here are my {request['cuisine']} restaurant(shop) suggestions for {request['people']} people, for {request['date']} at {request['time']}: {rest_message}. Enjoy your meal!"
+
+def hydrate_stage(request):
+    if 'restaurants' in request:
+        # already complete from the snapshot
+        request['message'] = recommendation_message(request, request['restaurants'])
+        return request
+
+    rand_business_ids = request['business_ids']
+
+    if rand_business_ids[0].startswith('Sorry! We do'):
+        # Send failure SNS message
+        request['message'] = rand_business_ids[0]
+        return request
+
+    # Find detailed information about the restaurants in one batch
+    rand_business_ids = unique_ids(rand_business_ids)
+    restaurants = dynamodb_batch_search(rand_business_ids)
+
+    found = [restaurants[business_id] for business_id in rand_business_ids if business_id in restaurants]
+    request['message'] = recommendation_message(request, found)
+    return request
+
+RECOMMENDATION_STAGES = [
+    ('search', search_stage),
+    ('hydrate', hydrate_stage)
+]
+
+
+# --------------------------------- staged pipeline over a bounded thread pool ---------------------------------
+
+# Maximum number of stage tasks running at once across all requests of a batch
+PIPELINE_CONCURRENCY = int(os.environ.get('PIPELINE_CONCURRENCY', '8'))
+
+# Pools by size, kept per calling thread. Lambda calls the handler on the
+# same thread every time, so a container keeps one pool and its threads keep
+# their DynamoDB resources (see clients.get_resource) across invocations.
+# Overlapping local invocations each get their own pool.
+_pools = threading.local()
+
+def pipeline_pool(concurrency):
+    pools = getattr(_pools, 'by_size', None)
+    if pools is None:
+        pools = _pools.by_size = {}
+    pool = pools.get(concurrency)
+    if pool is None:
+        pool = pools[concurrency] = ThreadPoolExecutor(max_workers=concurrency)
+    return pool
+
+class RecommendationPipeline:
+    # Every request moves through the stages in order, but stages of different
+    # requests share one pool, so Elasticsearch and DynamoDB round-trips
+    # of independent requests overlap instead of running back to back.
+
+    def __init__(self, stages=RECOMMENDATION_STAGES, concurrency=PIPELINE_CONCURRENCY):
+        self.stages = stages
+        self.concurrency = max(1, concurrency)
+        self._lock = threading.Lock()
+        self.metrics = {
+            name: {'queued': 0, 'running': 0, 'max_queue_depth': 0, 'completed': 0, 'failed': 0, 'seconds': 0.0}
+            for name, _ in stages
         }
-    )
 
-    print(response)
+    def run(self, dining_requests):
+        # Returns one entry per request: None on success, the raised exception otherwise
+        results = [Future() for _ in dining_requests]
 
+        executor = pipeline_pool(self.concurrency)
+        for request, result in zip(dining_requests, results):
+            self._submit(executor, 0, request, result)
+        wait(results)
 
-# --------------------------------- MAIN ---------------------------------
+        return [result.exception() for result in results]
 
-def lambda_handler(event, context):
+    def _submit(self, executor, index, value, result):
+        stage_metrics = self.metrics[self.stages[index][0]]
+        with self._lock:
+            stage_metrics['queued'] += 1
+            stage_metrics['max_queue_depth'] = max(stage_metrics['max_queue_depth'], stage_metrics['queued'])
 
-    # Collect message from SQS
-    info = dequeue()
-    location = info[0]
-
-    if location.startswith('Error while'):
-        print(location)
-
-    else:
-        cuisine = info[1]
-        date = info[2]
-        time = info[3]
-        people = info[4]
-        number = info[5]
-        
-        # Choose a random restaurant with the given cuisine
-        rand_business_ids = rand_elastic_search(location, cuisine)
-    
-        if rand_business_ids[0].startswith('Sorry! We do'):
-            # Send failure SNS message
-            sendsns(rand_business_ids[0], '+1' + number)
+        executor.submit(self._run_stage, executor, index, value, result)
+
+    def _run_stage(self, executor, index, value, result):
+        name, stage = self.stages[index]
+        stage_metrics = self.metrics[name]
+        with self._lock:
+            stage_metrics['queued'] -= 1
+            stage_metrics['running'] += 1
+
+        start = time.perf_counter()
+        try:
+            value = stage(value)
+        except Exception as e:
+            with self._lock:
+                stage_metrics['running'] -= 1
+                stage_metrics['failed'] += 1
+                stage_metrics['seconds'] += time.perf_counter() - start
+            result.set_exception(e)
+            return
 
+        with self._lock:
+            stage_metrics['running'] -= 1
+            stage_metrics['completed'] += 1
+            stage_metrics['seconds'] += time.perf_counter() - start
+
+        if index + 1 == len(self.stages):
+            result.set_result(value)
         else:
-            # Find detailed information about the restaurant
-            message_per_rest = []
-            for i in range(len(rand_business_ids)):
-                name, address, review_count, rating = dynamodb_search(rand_business_ids[i])
-                message_per_rest.append(f'{i + 1}. {name}, located at {address}')
-            rest_message = ", ".join(message_per_rest)
-            message = f'Hello! Here are my {cuisine} restaurant(shop) suggestions for {people} people, for {date} at {time}: {rest_message}. Enjoy your meal!'
-    
-            # Send sucess SNS message
-            sendsns(message, '+1' + number)
\ No newline at end of file
+            self._submit(executor, index + 1, value, result)
+
+def process_requests(dining_requests):
+    pipeline = RecommendationPipeline()
+    errors = pipeline.run(dining_requests)
+
+    # the SMS go out once the whole batch has its messages, so several
+    # recommendations for one number can share an SMS
+    ready = [index for index, error in enumerate(errors) if error is None]
+    dispatcher = SmsDispatcher()
+    sms_errors = dispatcher.dispatch([('+1' + dining_requests[index]['number'], dining_requests[index]['message']) for index in ready])
+    for index, error in zip(ready, sms_errors):
+        errors[index] = error
+
+    metrics.annotate('pipeline', pipeline.metrics)
+    metrics.annotate('sms', dispatcher.stats)
+    metrics.annotate('requests', len(dining_requests))
+    metrics.annotate('candidateCache', dict(candidate_cache.stats))
+    return errors
+
+
+# --------------------------------- SQS event source mode ---------------------------------
+
+# Requires ReportBatchItemFailures on the event source mapping, so only the
+# failed records of a batch are retried
+def sqs_event_handler(event, context):
+    batch_item_failures = []
+    dining_requests, message_ids = [], []
+
+    for record in event['Records']:
+        try:
+            dining_requests.append(parse_message(record))
+            message_ids.append(record['messageId'])
+        except Exception as e:
+            print(f"Failed to parse message {record['messageId']}: {e}")
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+
+    for message_id, error in zip(message_ids, process_requests(dining_requests)):
+        if error is not None:
+            print(f'Failed to process message {message_id}: {error}')
+            batch_item_failures.append({'itemIdentifier': message_id})
+
+    return {'batchItemFailures': batch_item_failures}
+
+
+# --------------------------------- polling mode (fallback) ---------------------------------
+
+def poll_handler(event, context):
+    sqs = clients.get_client('sqs')
+
+    # Collect messages from SQS
+    messages = dequeue(sqs)
+    if not messages:
+        print('Error while retrieving message from SQS!')
+        return
+
+    dining_requests, parsed = [], []
+    for message in messages:
+        try:
+            dining_requests.append(parse_message(message))
+            parsed.append(message)
+        except Exception as e:
+            print(f"Failed to parse message {message['MessageId']}: {e}")
+
+    processed = []
+    for message, error in zip(parsed, process_requests(dining_requests)):
+        if error is None:
+            processed.append(message)
+        else:
+            print(f"Failed to process message {message['MessageId']}: {error}")
+
+    delete_messages(sqs, processed)
+
+
+# --------------------------------- MAIN ---------------------------------
+
+@metrics.handler('LF2')
+def lambda_handler(event, context):
+    # Invoked by the SQS event source mapping
+    if event and 'Records' in event:
+        return sqs_event_handler(event, context)
+
+    # Invoked on a schedule, poll the queue instead
+    return poll_handler(event, context)
\ No newline at end of file
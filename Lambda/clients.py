@@ -0,0 +1,135 @@
+import os
+import threading
+
+
+# Shared by all Lambdas, package this file together with each function.
+# Everything is created lazily on first use and cached for the lifetime of
+# the container, so warm invocations reuse open keep-alive connections.
+# Even boto3 is only imported on first use: LF1 validates slots on most
+# invocations without calling AWS at all.
+
+REGION = 'us-east-1'
+ES_HOST = 'search-yelp-restaurant-jcwqo7mjstbw3yereil3vhezgy.us-east-1.es.amazonaws.com'
+MAX_POOL_CONNECTIONS = int(os.environ.get('MAX_POOL_CONNECTIONS', '25'))
+
+_lock = threading.RLock()
+_local = threading.local()
+_session = None
+_clients = {}
+_elasticsearch = None
+_http_session = None
+# stand-ins installed by override(), checked before anything is built
+_overrides = {}
+
+
+def _config():
+    from botocore.config import Config
+
+    return Config(
+        region_name = REGION,
+        max_pool_connections = MAX_POOL_CONNECTIONS,
+        tcp_keepalive = True,
+        retries = {'mode': 'standard'}
+    )
+
+def get_session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import boto3.session
+                _session = boto3.session.Session(region_name=REGION)
+    return _session
+
+def override(service_name, stand_in):
+    # Serve stand_in instead of the real client, for local benchmarks and
+    # tests. service_name is a boto3 client or resource name, 'elasticsearch'
+    # or 'http'. None removes the override.
+    with _lock:
+        if stand_in is None:
+            _overrides.pop(service_name, None)
+        else:
+            _overrides[service_name] = stand_in
+
+def get_client(service_name):
+    if _overrides and service_name in _overrides:
+        return _overrides[service_name]
+
+    client = _clients.get(service_name)
+    if client is None:
+        # creating clients from a shared session is not thread safe
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = get_session().client(service_name, config=_config())
+                _clients[service_name] = client
+    return client
+
+def get_resource(service_name):
+    if _overrides and service_name in _overrides:
+        return _overrides[service_name]
+
+    # boto3 resources are not thread safe, so each thread gets its own
+    resources = getattr(_local, 'resources', None)
+    if resources is None:
+        resources = _local.resources = {}
+
+    resource = resources.get(service_name)
+    if resource is None:
+        with _lock:
+            resource = get_session().resource(service_name, config=_config())
+        resources[service_name] = resource
+    return resource
+
+def get_table(table_name):
+    return get_resource('dynamodb').Table(table_name)
+
+def get_elasticsearch():
+    global _elasticsearch
+    if _overrides and 'elasticsearch' in _overrides:
+        return _overrides['elasticsearch']
+    if _elasticsearch is None:
+        with _lock:
+            if _elasticsearch is None:
+                _elasticsearch = _build_elasticsearch()
+    return _elasticsearch
+
+def _build_elasticsearch():
+    # imported here so functions that never talk to Elasticsearch do not need the packages
+    from elasticsearch import Elasticsearch, RequestsHttpConnection
+    from requests.adapters import HTTPAdapter
+    from requests_aws4auth import AWS4Auth
+
+    # signs every request with the current credentials instead of the ones
+    # seen at import time, so rotated session tokens are picked up
+    awsauth = AWS4Auth(refreshable_credentials=get_session().get_credentials(), region=REGION, service='es')
+
+    es = Elasticsearch(
+        hosts = [{'host': ES_HOST, 'port': 443}],
+        http_auth = awsauth,
+        use_ssl = True,
+        verify_certs = True,
+        connection_class = RequestsHttpConnection
+    )
+
+    # requests keeps 10 pooled connections per host by default
+    for connection in es.transport.connection_pool.connections:
+        connection.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_POOL_CONNECTIONS))
+
+    return es
+
+def get_http_session():
+    # pooled keep-alive session for plain HTTPS APIs such as Yelp
+    global _http_session
+    if _overrides and 'http' in _overrides:
+        return _overrides['http']
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_maxsize=MAX_POOL_CONNECTIONS))
+                _http_session = session
+    return _http_session
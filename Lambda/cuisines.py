@@ -0,0 +1,19 @@
+# Cuisines the concierge serves, shared by the Lambdas. Package this file
+# together with each function that imports it.
+
+# Yelp category aliases that make up each cuisine. The restaurants index
+# stores categories.alias as a keyword, so a cuisine is an exact terms
+# filter instead of a full-text match on the category title.
+CUISINE_CATEGORIES = {
+    'korean': ['korean'],
+    'chinese': ['chinese', 'cantonese', 'dimsum', 'hotpot', 'shanghainese', 'szechuan', 'taiwanese'],
+    'coffee': ['coffee', 'coffeeroasteries', 'cafes'],
+    'american': ['tradamerican', 'newamerican'],
+    'indian': ['indpak'],
+    'japanese': ['japanese', 'sushi', 'ramen', 'izakaya']
+}
+
+
+def category_aliases(cuisine):
+    cuisine = cuisine.lower()
+    return CUISINE_CATEGORIES.get(cuisine, [cuisine])
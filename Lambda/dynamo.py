@@ -0,0 +1,41 @@
+import time
+
+import clients
+import metrics
+import throttle
+
+
+# DynamoDB helpers shared by LF-Yelp and LF2. Package this file together
+# with both functions.
+
+BATCH_GET_LIMIT = 100  # maximum keys per BatchGetItem request
+BATCH_GET_MAX_ATTEMPTS = 5
+BATCH_GET_BASE_DELAY = 0.05
+
+
+def batch_get(table_name, ids, projection=None, names=None):
+    # Yields the items of the given ids, once each, in BatchGetItem chunks.
+    # Keys DynamoDB leaves unprocessed are retried with jittered backoff.
+    dynamodb = clients.get_resource('dynamodb')
+    ids = list(dict.fromkeys(ids))
+
+    for i in range(0, len(ids), BATCH_GET_LIMIT):
+        request = {'Keys': [{'id': item_id} for item_id in ids[i:i + BATCH_GET_LIMIT]]}
+        if projection:
+            request['ProjectionExpression'] = projection
+        if names:
+            request['ExpressionAttributeNames'] = names
+        request_items = {table_name: request}
+
+        attempt = 0
+        while request_items:
+            with metrics.span('dynamodb', 'batch_get_item'):
+                response = dynamodb.batch_get_item(RequestItems=request_items)
+            yield from response['Responses'].get(table_name, [])
+
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                attempt += 1
+                if attempt >= BATCH_GET_MAX_ATTEMPTS:
+                    raise RuntimeError(f'BatchGetItem left keys unprocessed after {attempt} attempts')
+                time.sleep(throttle.jittered_backoff(attempt, base=BATCH_GET_BASE_DELAY))
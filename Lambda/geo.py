@@ -0,0 +1,108 @@
+import json
+import os
+
+
+# Locations the concierge serves and the geohash cells that cover them,
+# shared by the Lambdas. Package this file together with each function
+# that imports it.
+
+# name -> (south, west, north, east) bounding box
+LOCATIONS = {
+    'manhattan': (40.6996, -74.0200, 40.8820, -73.9070),
+    'new york': (40.4774, -74.2591, 40.9176, -73.7004)
+}
+# more boroughs or cities without a code change, as a JSON object of
+# name -> [south, west, north, east]
+LOCATIONS.update({
+    name.lower(): tuple(bounds)
+    for name, bounds in json.loads(os.environ.get('SERVED_LOCATIONS') or '{}').items()
+})
+
+# Restaurants are indexed under every prefix of their geohash from
+# MIN_PRECISION to MAX_PRECISION. A location is covered at the finest of
+# those precisions that needs at most MAX_CELLS cells, so a query never
+# filters on more than MAX_CELLS terms however large the catalog grows.
+MIN_PRECISION = 4
+MAX_PRECISION = 6
+MAX_CELLS = 64
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode(lat, lon, precision=MAX_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    cell = []
+    bits = 0
+    value = 0
+    even = True
+
+    while len(cell) < precision:
+        # bits alternate between longitude and latitude, longitude first
+        value_range, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (value_range[0] + value_range[1]) / 2
+        if coordinate >= middle:
+            value = value * 2 + 1
+            value_range[0] = middle
+        else:
+            value = value * 2
+            value_range[1] = middle
+        even = not even
+
+        bits += 1
+        if bits == 5:
+            cell.append(BASE32[value])
+            bits = 0
+            value = 0
+
+    return ''.join(cell)
+
+def prefixes(lat, lon):
+    # every indexed prefix of the geohash at (lat, lon), coarsest first
+    cell = encode(lat, lon, MAX_PRECISION)
+    return [cell[:precision] for precision in range(MIN_PRECISION, MAX_PRECISION + 1)]
+
+def cell_size(precision):
+    # (latitude, longitude) extent of a cell in degrees
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+def cover(bounds, precision):
+    # cells at `precision` that intersect the bounding box
+    south, west, north, east = bounds
+    lat_step, lon_step = cell_size(precision)
+
+    cells = []
+    # sample the centre of every cell row and column the box touches
+    lat = (south // lat_step) * lat_step + lat_step / 2
+    while lat - lat_step / 2 < north:
+        lon = (west // lon_step) * lon_step + lon_step / 2
+        while lon - lon_step / 2 < east:
+            cells.append(encode(lat, lon, precision))
+            lon += lon_step
+        lat += lat_step
+    return cells
+
+def cover_precision(bounds):
+    south, west, north, east = bounds
+    for precision in range(MAX_PRECISION, MIN_PRECISION - 1, -1):
+        lat_step, lon_step = cell_size(precision)
+        rows = int(north // lat_step - south // lat_step) + 1
+        columns = int(east // lon_step - west // lon_step) + 1
+        if rows * columns <= MAX_CELLS:
+            return precision
+    return MIN_PRECISION
+
+def location_cells(location):
+    # every cell covering a served location, None when it is not served
+    bounds = LOCATIONS.get(location.lower()) if location else None
+    if bounds is None:
+        return None
+    return cover(bounds, cover_precision(bounds))
+
+def center(location):
+    bounds = LOCATIONS.get(location.lower()) if location else None
+    if bounds is None:
+        return None
+    south, west, north, east = bounds
+    return (south + north) / 2, (west + east) / 2
@@ -0,0 +1,126 @@
+import functools
+import json
+import os
+import threading
+import time
+from random import random
+
+
+# Per-invocation timing of external calls, shared by the Lambdas. Package
+# this file together with each function.
+#
+#   @metrics.handler('LF2')
+#   def lambda_handler(event, context): ...
+#
+#   with metrics.span('sns', 'publish'):
+#       sns.publish(...)
+#
+# A sampled invocation prints one JSON line with the count, total and
+# slowest time of every span name plus any annotations. Unsampled
+# invocations and spans outside a handler cost one global read.
+
+# share of invocations that emit a record, 0 turns metrics off
+SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '1'))
+
+# Lambda runs one invocation per container at a time, so the record is
+# process wide and spans on pipeline worker threads land in it too
+_current = None
+
+
+class InvocationRecord:
+
+    def __init__(self, name, context=None):
+        self.name = name
+        self.request_id = getattr(context, 'aws_request_id', None)
+        self.started = time.perf_counter()
+        # span name -> [count, total seconds, max seconds, errors]
+        self.spans = {}
+        self.annotations = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, failed):
+        with self._lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+            if failed:
+                stats[3] += 1
+
+    def emit(self):
+        record = {
+            'handler': self.name,
+            'requestId': self.request_id,
+            'durationMs': round((time.perf_counter() - self.started) * 1000, 2),
+            'spans': {
+                name: {'count': count, 'totalMs': round(total * 1000, 2), 'maxMs': round(slowest * 1000, 2), 'errors': errors}
+                for name, (count, total, slowest, errors) in sorted(self.spans.items())
+            }
+        }
+        record.update(self.annotations)
+        print(json.dumps({'metrics': record}, default=str))
+
+class _Span:
+    __slots__ = ('record', 'name', 'start')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.record.add(self.name, time.perf_counter() - self.start, exc_type is not None)
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+
+def span(service, operation):
+    # times one external call, e.g. span('sqs', 'send_message')
+    record = _current
+    if record is None:
+        return _NO_SPAN
+    return _Span(record, service + '.' + operation)
+
+def annotate(name, value):
+    # adds a field to the record of a sampled invocation
+    record = _current
+    if record is not None:
+        record.annotations[name] = value
+
+def handler(name):
+    # decorates a lambda_handler so sampled invocations emit a record
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(event, context):
+            global _current
+            # nested handlers (local benchmarks) report into the outer record
+            if _current is not None or SAMPLE_RATE <= 0 or random() >= SAMPLE_RATE:
+                return function(event, context)
+
+            record = _current = InvocationRecord(name, context)
+            try:
+                return function(event, context)
+            except Exception as e:
+                record.annotations['error'] = type(e).__name__
+                raise
+            finally:
+                _current = None
+                record.emit()
+        return wrapper
+    return decorate
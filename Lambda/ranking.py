@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+
+import geo
+
+
+# Scores every candidate of a cuisine in one vectorized pass and samples
+# the recommendations from the best of them. Used by LF2.
+
+# Bayesian average: a rating counts as much as PRIOR_REVIEWS reviews at the
+# mean rating of the candidates, so a 5.0 with 3 reviews does not beat a
+# 4.5 with 2000
+PRIOR_REVIEWS = float(os.environ.get('RANKING_PRIOR_REVIEWS', '50'))
+RATING_WEIGHT = float(os.environ.get('RANKING_RATING_WEIGHT', '0.5'))
+REVIEWS_WEIGHT = float(os.environ.get('RANKING_REVIEWS_WEIGHT', '0.2'))
+DISTANCE_WEIGHT = float(os.environ.get('RANKING_DISTANCE_WEIGHT', '0.3'))
+# distance at which the proximity score has dropped to 1/e
+DISTANCE_SCALE_KM = float(os.environ.get('RANKING_DISTANCE_SCALE_KM', '3'))
+# recommendations are sampled from this many of the best candidates
+TOP_N = int(os.environ.get('RANKING_TOP_N', '20'))
+# lower is greedier, higher is closer to uniform over the top candidates
+TEMPERATURE = float(os.environ.get('RANKING_TEMPERATURE', '0.1'))
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat, lon, center_lat, center_lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    center_lat, center_lon = np.radians(center_lat), np.radians(center_lon)
+    a = np.sin((lat - center_lat) / 2) ** 2 + np.cos(lat) * np.cos(center_lat) * np.sin((lon - center_lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def score(rating, review_count, lat=None, lon=None, center=None):
+    rating = np.nan_to_num(np.asarray(rating, dtype=np.float64), nan=0.0)
+    reviews = np.asarray(review_count, dtype=np.float64)
+
+    mean_rating = rating.mean() if rating.size else 0.0
+    bayesian = (reviews * rating + PRIOR_REVIEWS * mean_rating) / (reviews + PRIOR_REVIEWS)
+    scores = RATING_WEIGHT * (bayesian / 5.0)
+
+    max_log_reviews = np.log1p(reviews.max()) if reviews.size else 0.0
+    if max_log_reviews > 0:
+        scores += REVIEWS_WEIGHT * (np.log1p(reviews) / max_log_reviews)
+
+    if center is not None and lat is not None and lon is not None:
+        distance = haversine_km(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64), *center)
+        # unknown coordinates get no proximity credit
+        scores += DISTANCE_WEIGHT * np.nan_to_num(np.exp(-distance / DISTANCE_SCALE_KM), nan=0.0)
+
+    return scores
+
+
+def sample_top(scores, count, seed=None, top_n=TOP_N):
+    # positions of `count` candidates drawn without replacement from the
+    # top_n scores, weighted by a softmax over those scores
+    size = len(scores)
+    count = min(count, size)
+    if count == 0:
+        return np.empty(0, dtype=np.intp)
+
+    top_n = max(count, min(top_n, size))
+    if top_n < size:
+        top = np.argpartition(-scores, top_n - 1)[:top_n]
+    else:
+        top = np.arange(size)
+
+    weights = np.exp((scores[top] - scores[top].max()) / TEMPERATURE)
+    weights /= weights.sum()
+    return np.random.default_rng(seed).choice(top, size=count, replace=False, p=weights)
+
+
+def rank_and_sample(rating, review_count, lat, lon, count, location=None, seed=None):
+    center = geo.center(location)
+    return sample_top(score(rating, review_count, lat, lon, center), count, seed)
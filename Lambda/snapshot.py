@@ -0,0 +1,144 @@
+import mmap
+import struct
+import time
+
+
+# Compact restaurant snapshot written by LF-Yelp and read by LF2. Package
+# this file together with both functions.
+#
+# Layout (little endian):
+#   header        magic, format version, ingest generation, creation time,
+#                 record count, cuisine count
+#   groups        fixed-width name plus (start, count) into the member array,
+#                 one group per cuisine and per cuisine within a geohash cell
+#   members       uint32 record numbers, grouped by group
+#   records       fixed-width id/name/address/rating/review_count/lat/lon
+#
+# Everything is fixed width, so a reader maps the file and slices it
+# without parsing or copying.
+
+MAGIC = b'RSNP'
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct('<4sHHQQII')
+CUISINE = struct.Struct('<32sII')
+MEMBER = struct.Struct('<I')
+RECORD = struct.Struct('<32s64s96sfIff')
+
+
+def _fixed(text, width):
+    # truncate on a character boundary so the bytes always decode
+    data = (text or '').encode('utf-8')[:width]
+    return data.decode('utf-8', 'ignore').encode('utf-8')
+
+def group(cuisine, cell):
+    # name of the group holding the restaurants of a cuisine inside a geohash cell
+    return f'{cuisine}@{cell}'
+
+def _text(data):
+    return data.rstrip(b'\0').decode('utf-8')
+
+def _float(value):
+    return float(value) if value not in (None, '') else float('nan')
+
+
+def build_snapshot(generation, restaurants, cuisine_members, created_at=None):
+    # restaurants: dicts with id, name, address (display string), rating,
+    # review_count, latitude and longitude. cuisine_members: group name (a
+    # cuisine, or group(cuisine, cell)) to the positions of its restaurants
+    # in that list.
+    if created_at is None:
+        created_at = int(time.time())
+
+    cuisines = sorted(cuisine_members)
+    parts = [HEADER.pack(MAGIC, FORMAT_VERSION, 0, int(generation), int(created_at), len(restaurants), len(cuisines))]
+
+    start = 0
+    for cuisine in cuisines:
+        count = len(cuisine_members[cuisine])
+        parts.append(CUISINE.pack(_fixed(cuisine, 32), start, count))
+        start += count
+
+    for cuisine in cuisines:
+        parts.extend(MEMBER.pack(position) for position in cuisine_members[cuisine])
+
+    for restaurant in restaurants:
+        parts.append(RECORD.pack(
+            _fixed(restaurant['id'], 32),
+            _fixed(restaurant['name'], 64),
+            _fixed(restaurant['address'], 96),
+            _float(restaurant.get('rating')),
+            int(restaurant.get('review_count') or 0),
+            _float(restaurant.get('latitude')),
+            _float(restaurant.get('longitude'))
+        ))
+
+    return b''.join(parts)
+
+
+class Snapshot:
+    # Read-only view over a snapshot file mapped into memory
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, generation, created_at, record_count, cuisine_count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a version {FORMAT_VERSION} restaurant snapshot')
+
+        self.generation = generation
+        self.created_at = created_at
+        self.record_count = record_count
+        self._table = None
+
+        offset = HEADER.size
+        cuisines = {}
+        for _ in range(cuisine_count):
+            name, start, count = CUISINE.unpack_from(self._map, offset)
+            cuisines[_text(name)] = (start, count)
+            offset += CUISINE.size
+
+        members_offset = offset
+        member_count = sum(count for _, count in cuisines.values())
+        self._records_offset = members_offset + member_count * MEMBER.size
+
+        view = memoryview(self._map)
+        self._cuisines = {
+            name: view[members_offset + start * MEMBER.size:members_offset + (start + count) * MEMBER.size].cast('I')
+            for name, (start, count) in cuisines.items()
+        }
+
+    def cuisines(self):
+        return list(self._cuisines)
+
+    def members(self, cuisine):
+        # record numbers of a group, an empty sequence when it is unknown
+        return self._cuisines.get(cuisine, ())
+
+    def record(self, number):
+        business_id, name, address, rating, review_count, latitude, longitude = RECORD.unpack_from(
+            self._map, self._records_offset + number * RECORD.size)
+        return {
+            'id': _text(business_id),
+            'name': _text(name),
+            'address': _text(address),
+            'rating': rating,
+            'review_count': review_count,
+            'latitude': latitude,
+            'longitude': longitude
+        }
+
+    def table(self):
+        # every record as a numpy structured array viewing the mapped file
+        if self._table is None:
+            import numpy as np
+            dtype = np.dtype([
+                ('id', 'S32'), ('name', 'S64'), ('address', 'S96'),
+                ('rating', '<f4'), ('review_count', '<u4'), ('latitude', '<f4'), ('longitude', '<f4')
+            ])
+            self._table = np.frombuffer(self._map, dtype=dtype, count=self.record_count, offset=self._records_offset)
+        return self._table
+
+    def age(self):
+        return time.time() - self.created_at
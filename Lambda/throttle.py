@@ -0,0 +1,46 @@
+import random
+import threading
+import time
+
+
+# Rate limiting and retry helpers shared by the Lambdas, package this file
+# together with each function that uses it.
+
+class TokenBucket:
+    # Allows `rate` acquisitions per second on average with bursts of up to
+    # `capacity`. Safe to share between threads.
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        # blocks until the tokens are available
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def jittered_backoff(attempt, base=0.1, cap=10.0):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,198 @@
+"""Runs a full LF-Yelp catalog rebuild locally, as one crawl and as a fan-out.
+
+Both run against the in-memory services in fakes.py with injected latency.
+The fan-out coordinator queues its work units on the fake SQS queue. A
+pool of in-process workers then takes one unit at a time, the way the SQS
+event source mapping hands them to concurrent LF-Yelp invocations. A unit
+that fails goes back on the queue, like a batch item failure.
+
+It exits with status 1 when a crawl does not finish or leaves a catalog
+whose served documents do not match the live restaurants. That is also
+checked with an Elasticsearch that rejects every other new document once,
+for a rebuild and for an update, as a single crawl and as a fan-out.
+
+    python bench/bench_fanout.py
+    python bench/bench_fanout.py --workers 1,8,32 --yelp-total 1000 --shard-pages 2
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Lambda'))
+
+import fakes
+import metrics
+import throttle
+
+
+MAX_DELIVERIES = 3
+# Yelp businesses per cuisine in the rejected documents check
+REJECTED_CHECK_TOTAL = 200
+
+def catalog(services, yelp):
+    # live restaurants in DynamoDB and documents behind the Elasticsearch alias
+    table = services.dynamodb.Table(yelp.RESTAURANT_TABLE)
+    live = sum(1 for item in table.items.values() if not item.get('tombstoned'))
+    documents = sum(len(services.elasticsearch.indices_data.get(index, {}))
+                    for index in services.elasticsearch.resolve(yelp.ES_ALIAS))
+    return live, documents
+
+def run_single(services, yelp):
+    services.log.reset()
+    start = time.perf_counter()
+    body = json.loads(yelp.lambda_handler({'rebuild': True}, None)['body'])
+    elapsed = time.perf_counter() - start
+    return {
+        'seconds': round(elapsed, 3),
+        'invocations': 1,
+        'pages': body['fetchedPages'],
+        'generation': body['generation'],
+        'finished': not body['remainingPages'] and not body['retryIds']
+    }
+
+def run_fanout(services, yelp, workers, rebuild=True):
+    services.log.reset()
+    start = time.perf_counter()
+    coordinator = json.loads(yelp.lambda_handler({'fanout': True, 'rebuild': rebuild}, None)['body'])
+
+    invocations, failures = 1, 0
+    deliveries = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(services.sqs):
+            # every queued unit goes to its own worker invocation
+            records = [services.sqs.take_records(1) for _ in range(len(services.sqs))]
+            results = list(executor.map(lambda record: yelp.lambda_handler({'Records': record}, None), records))
+            invocations += len(records)
+
+            for record, result in zip(records, results):
+                if not result['batchItemFailures']:
+                    continue
+                failures += 1
+                deliveries[record[0]['body']] = deliveries.get(record[0]['body'], 1) + 1
+                if deliveries[record[0]['body']] <= MAX_DELIVERIES:
+                    services.sqs.send_message(QueueUrl=yelp.INGEST_QUEUE_URL, MessageBody=record[0]['body'])
+    elapsed = time.perf_counter() - start
+
+    fanout = services.dynamodb.Table(yelp.STATE_TABLE).items[yelp.FANOUT_ID]
+    return {
+        'seconds': round(elapsed, 3),
+        'invocations': invocations,
+        'units': coordinator['units'],
+        'failedUnits': failures,
+        'finished': 'finishedAtTimestamp' in fanout
+    }
+
+def mismatches(name, result):
+    # why a crawl did not leave a complete catalog behind
+    problems = []
+    if not result['finished']:
+        problems.append(f'{name} did not finish')
+    if result['documents'] != result['restaurants']:
+        problems.append(f"{name} serves {result['documents']} documents for {result['restaurants']} restaurants")
+    return problems
+
+def run_checkpointed(services, yelp, rebuild):
+    # invokes a single crawl until it finishes, as the schedule would
+    problems = []
+    for _ in range(MAX_DELIVERIES):
+        body = json.loads(yelp.lambda_handler({'rebuild': rebuild}, None)['body'])
+        if body['retryIds'] and body['index'] in services.elasticsearch.resolve(yelp.ES_ALIAS):
+            problems.append(f"{body['index']} is served while {body['retryIds']} documents are missing")
+        if not body['remainingPages'] and not body['retryIds']:
+            return True, problems
+    return False, problems
+
+def check_rejected_documents(latency, yelp, workers):
+    # The catalog is complete in the end, although Elasticsearch rejects
+    # every other new document the first time: after a rebuild, and after
+    # an update that brings new restaurants
+    problems = []
+    crawls = [
+        ('single crawl', lambda services, rebuild: run_checkpointed(services, yelp, rebuild)),
+        ('fan-out', lambda services, rebuild: (run_fanout(services, yelp, workers, rebuild)['finished'], []))
+    ]
+    for name, crawl in crawls:
+        services = fakes.FakeServices(latency, yelp_total=REJECTED_CHECK_TOTAL).install()
+        services.elasticsearch.reject_every = 2
+        for rebuild in (True, False):
+            finished, crawl_problems = crawl(services, rebuild)
+            result = {'finished': finished}
+            result['restaurants'], result['documents'] = catalog(services, yelp)
+            problems += crawl_problems + mismatches(f"{name} {'rebuild' if rebuild else 'update'}", result)
+            # the update finds more restaurants than the rebuild
+            services.yelp.total += REJECTED_CHECK_TOTAL
+        if not services.elasticsearch.rejected:
+            problems.append(f'{name} never had a document rejected')
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,4,16', help='comma separated worker pool sizes')
+    parser.add_argument('--yelp-total', type=int, default=1000, help='fake Yelp businesses per cuisine')
+    parser.add_argument('--yelp-qps', type=float, default=200, help='Yelp rate limit shared by all workers')
+    parser.add_argument('--shard-pages', type=int, default=4, help='Yelp pages per work unit')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='multiplies every injected latency')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    latency = {service: ms * args.latency_scale for service, ms in fakes.DEFAULT_LATENCY_MS.items()}
+
+    # invocations overlap in this process, which the per-invocation record does not support
+    metrics.SAMPLE_RATE = 0
+
+    yelp = importlib.import_module('LF-Yelp')
+    # the Yelp limit belongs to the API key, so every worker shares one bucket
+    yelp.yelpRateLimit = throttle.TokenBucket(args.yelp_qps)
+    yelp.INGEST_QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/yelpIngestUnits'
+    yelp.SHARD_PAGES = args.shard_pages
+
+    report = {'latency_ms': latency, 'runs': [], 'problems': []}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for workers in (int(size) for size in args.workers.split(',')):
+            # a fresh catalog each time, so every run loads everything
+            services = fakes.FakeServices(latency, yelp_total=args.yelp_total).install()
+            single = run_single(services, yelp)
+            single['restaurants'], single['documents'] = catalog(services, yelp)
+
+            services = fakes.FakeServices(latency, yelp_total=args.yelp_total).install()
+            fanout = run_fanout(services, yelp, workers)
+            fanout['restaurants'], fanout['documents'] = catalog(services, yelp)
+            fanout['yelpCalls'] = services.log.counts().get(('yelp', 'search'), 0)
+            report['runs'].append({'workers': workers, 'single': single, 'fanout': fanout})
+
+            report['problems'] += mismatches(f'single crawl with {workers} workers', single)
+            report['problems'] += mismatches(f'fan-out with {workers} workers', fanout)
+            if single['restaurants'] != fanout['restaurants']:
+                report['problems'].append(f"with {workers} workers the single crawl loaded {single['restaurants']} "
+                                          f"restaurants and the fan-out {fanout['restaurants']}")
+
+        report['problems'] += check_rejected_documents(latency, yelp, max(int(size) for size in args.workers.split(',')))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        sys.exit(1 if report['problems'] else 0)
+
+    for run in report['runs']:
+        single, fanout = run['single'], run['fanout']
+        print(f"{run['workers']} workers: single crawl {single['seconds']} s, "
+              f"fan-out {fanout['seconds']} s over {fanout['units']} units and {fanout['invocations']} invocations "
+              f"({fanout['failedUnits']} retried, {fanout['yelpCalls']} Yelp calls, finished {fanout['finished']})")
+        print(f"    restaurants {single['restaurants']} / {fanout['restaurants']}, "
+              f"indexed documents {single['documents']} / {fanout['documents']}")
+
+    for problem in report['problems']:
+        print(f'FAILED: {problem}')
+    if report['problems']:
+        sys.exit(1)
+    print('all crawls left a complete catalog, also with rejected documents')
+
+
+if __name__ == '__main__':
+    main()
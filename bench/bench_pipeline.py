@@ -0,0 +1,210 @@
+"""End-to-end offline benchmark of the concierge pipeline.
+
+Runs the real handlers against the in-memory services in fakes.py, each
+call delayed by an injected latency:
+
+    ingest     LF-Yelp loads the fake Yelp catalog into DynamoDB and Elasticsearch
+    chat       LF0 -> Lex -> LF1 -> SQS, one request per simulated user
+    recommend  LF2 drains the queue in SQS event source batches of 10
+
+For every concurrency level it reports the p50/p99 of each stage and of
+each service operation, the calls per request and the throughput.
+
+    python bench/bench_pipeline.py
+    python bench/bench_pipeline.py --requests 500 --concurrency 1,8,32 --latency lex-runtime=80,sns=40
+    python bench/bench_pipeline.py --latency-scale 0 --json
+    python bench/bench_pipeline.py --sns-rate 20
+    python bench/bench_pipeline.py --sms-rate-limit 100000
+"""
+import argparse
+import contextlib
+import datetime
+import importlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Lambda'))
+
+import fakes
+import metrics
+import throttle
+
+
+SQS_BATCH_SIZE = 10
+CUISINES = ['korean', 'chinese', 'coffee', 'american', 'indian', 'japanese']
+LOCATIONS = ['manhattan', 'new york']
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(durations):
+    return {
+        'count': len(durations),
+        'p50_ms': round(percentile(durations, 0.50) * 1000, 2) if durations else None,
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 2) if durations else None
+    }
+
+def timed(function, durations):
+    def run(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            durations.append(time.perf_counter() - start)
+    return run
+
+def chat_event(number):
+    tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+    slots = {
+        'location': LOCATIONS[number % len(LOCATIONS)],
+        'cuisine': CUISINES[number % len(CUISINES)],
+        'num_people': str(1 + number % 8),
+        'date': tomorrow,
+        'given_time': '19:30',
+        'phone_num': '212555%04d' % (number % 10000)
+    }
+    text = ';'.join(f'{slot}={value}' for slot, value in slots.items())
+    return {
+        'body': json.dumps({'messages': [{'type': 'unstructured', 'unstructured': {'text': text, 'userId': f'user-{number}'}}]}),
+        'requestContext': {'accountId': 'benchmark'}
+    }
+
+def run_ingest(services, handlers):
+    services.log.reset()
+    start = time.perf_counter()
+    response = handlers['LF-Yelp'].lambda_handler({}, None)
+    elapsed = time.perf_counter() - start
+
+    body = json.loads(response['body'])
+    return {
+        'seconds': round(elapsed, 3),
+        'fetchedPages': body['fetchedPages'],
+        'written': body['written'],
+        'indexed': body['indexed'],
+        'calls': {f'{service}.{operation}': count for (service, operation), count in sorted(services.log.counts().items())}
+    }
+
+def run_level(services, handlers, requests, concurrency, offset):
+    services.log.reset()
+    stages = {'LF0 request': [], 'LF2 batch': []}
+    published, throttled = len(services.sns.published), services.sns.throttled
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        responses = list(executor.map(timed(handlers['LF0'].lambda_handler, stages['LF0 request']),
+                                      [chat_event(offset + number) for number in range(requests)],
+                                      [None] * requests))
+    chat_seconds = time.perf_counter() - start
+    failed_chats = sum(1 for response in responses if response['statusCode'] != 200)
+
+    start = time.perf_counter()
+    batches = []
+    while len(services.sqs):
+        batches.append({'Records': services.sqs.take_records(SQS_BATCH_SIZE)})
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed(handlers['LF2'].lambda_handler, stages['LF2 batch']), batches, [None] * len(batches)))
+    recommend_seconds = time.perf_counter() - start
+    failed_records = sum(len(result['batchItemFailures']) for result in results)
+
+    calls = services.log.snapshot()
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'failedChats': failed_chats,
+        'failedRecommendations': failed_records,
+        'sms': {'sent': len(services.sns.published) - published, 'throttled': services.sns.throttled - throttled},
+        'throughput_rps': {
+            'chat': round(requests / chat_seconds, 1),
+            'recommend': round(requests / recommend_seconds, 1) if recommend_seconds else None,
+            'end_to_end': round(requests / (chat_seconds + recommend_seconds), 1)
+        },
+        'stages': {name: summarize(durations) for name, durations in stages.items()},
+        'services': {
+            f'{service}.{operation}': dict(summarize(durations), per_request=round(len(durations) / requests, 2))
+            for (service, operation), durations in sorted(calls.items())
+        }
+    }
+
+def print_report(report):
+    ingest = report['ingest']
+    print(f"ingest: {ingest['seconds']} s, {ingest['fetchedPages']} pages, {ingest['written']} written, {ingest['indexed']} indexed")
+    for name, count in ingest['calls'].items():
+        print(f'    {name:36s} {count:6d} calls')
+
+    for level in report['levels']:
+        throughput = level['throughput_rps']
+        print()
+        print(f"concurrency {level['concurrency']}: {level['requests']} requests, "
+              f"{throughput['chat']} chat/s, {throughput['recommend']} recommend/s, {throughput['end_to_end']} end to end/s, "
+              f"{level['failedChats']} failed chats, {level['failedRecommendations']} failed recommendations, "
+              f"{level['sms']['sent']} SMS sent, {level['sms']['throttled']} throttled")
+        print(f"    {'stage / call':36s} {'p50 ms':>8s} {'p99 ms':>8s} {'calls':>7s} {'/req':>6s}")
+        for name, stats in level['stages'].items():
+            print(f"    {name:36s} {stats['p50_ms']:8.2f} {stats['p99_ms']:8.2f} {stats['count']:7d}")
+        for name, stats in level['services'].items():
+            print(f"    {name:36s} {stats['p50_ms']:8.2f} {stats['p99_ms']:8.2f} {stats['count']:7d} {stats['per_request']:6.2f}")
+
+def parse_latency(text):
+    latency = {}
+    for pair in filter(None, (text or '').split(',')):
+        service, ms = pair.split('=')
+        latency[service.strip()] = float(ms)
+    return latency
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='dining requests per concurrency level')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma separated concurrency levels')
+    parser.add_argument('--latency', default='', help='service=ms overrides, e.g. sns=40,lex-runtime=80')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='multiplies every injected latency')
+    parser.add_argument('--yelp-total', type=int, default=200, help='fake Yelp businesses per cuisine')
+    parser.add_argument('--yelp-qps', type=float, default=50, help='LF-Yelp rate limit for the fake Yelp')
+    parser.add_argument('--sns-rate', type=float, help='SMS per second the fake SNS accepts before throttling')
+    parser.add_argument('--sms-rate-limit', type=float,
+                        help="LF2's SMS rate limit shared by all simulated containers, by default its SMS_RATE per container")
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    latency = dict(fakes.DEFAULT_LATENCY_MS, **parse_latency(args.latency))
+    latency = {service: ms * args.latency_scale for service, ms in latency.items()}
+
+    # invocations overlap in this process, which the per-invocation record does not support
+    metrics.SAMPLE_RATE = 0
+
+    handlers = {name: importlib.import_module(name) for name in ['LF0', 'LF1', 'LF2', 'LF-Yelp']}
+    # every simulated user keeps their own Lex dialog
+    handlers['LF0'].CLIENT_USER_IDS = True
+    handlers['LF-Yelp'].yelpRateLimit = throttle.TokenBucket(args.yelp_qps)
+    services = fakes.FakeServices(latency, code_hook=handlers['LF1'].lambda_handler, yelp_total=args.yelp_total,
+                                  sns_rate=args.sns_rate).install()
+
+    # the handlers log every request, which would swamp the report
+    report = {'latency_ms': latency}
+    with contextlib.redirect_stdout(io.StringIO()):
+        report['ingest'] = run_ingest(services, handlers)
+        report['levels'] = []
+        offset = 0
+        for concurrency in (int(level) for level in args.concurrency.split(',')):
+            # every Lambda container has its own bucket, the simulated ones share one
+            sms_rate = args.sms_rate_limit or handlers['LF2'].SMS_RATE * concurrency
+            handlers['LF2'].sms_rate_limit = throttle.TokenBucket(sms_rate)
+            report['levels'].append(run_level(services, handlers, args.requests, concurrency, offset))
+            offset += args.requests
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
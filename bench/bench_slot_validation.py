@@ -0,0 +1,102 @@
+"""Per-turn cost of LF1's slot validation.
+
+Replays a DiningSuggestionsIntent conversation through
+``LF1.dining_suggestion_intent`` the way Lex drives it, with one
+DialogCodeHook call per turn and one more slot filled each turn. It runs
+with and without the validated values Lex hands back in the session
+attributes.
+
+    python bench/bench_slot_validation.py
+    python bench/bench_slot_validation.py --conversations 20000
+"""
+import argparse
+import contextlib
+import copy
+import datetime
+import io
+import os
+import sys
+import time
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Lambda'))
+
+import LF1
+
+
+def conversation():
+    # the DialogCodeHook requests of one conversation, one slot more per turn
+    tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+    answers = [
+        ('location', 'Manhattan'),
+        ('cuisine', 'Japanese'),
+        ('num_people', '4'),
+        ('date', tomorrow),
+        ('given_time', '19:30'),
+        ('phone_num', '2125550123')
+    ]
+
+    slots = {slot: None for slot, _ in answers}
+    turns = []
+    for slot, value in answers:
+        slots[slot] = value
+        turns.append({
+            'invocationSource': 'DialogCodeHook',
+            'sessionAttributes': {},
+            'currentIntent': {'name': 'DiningSuggestionsIntent', 'slots': dict(slots)}
+        })
+    return turns
+
+def run(turns, conversations, carry_session):
+    # seconds spent per turn, session attributes flow from turn to turn
+    # like Lex returns them when carry_session is set
+    requests = [[copy.deepcopy(turn) for turn in turns] for _ in range(conversations)]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for conversation_turns in requests:
+            session = {}
+            for request in conversation_turns:
+                if carry_session:
+                    request['sessionAttributes'] = session
+                response = LF1.dining_suggestion_intent(request)
+                session = response['sessionAttributes']
+        elapsed = time.perf_counter() - start
+
+    return elapsed / (conversations * len(turns))
+
+def run_validation_only(turns, conversations, carry_session):
+    slots = [turn['currentIntent']['slots'] for turn in turns]
+
+    start = time.perf_counter()
+    for _ in range(conversations):
+        session = {}
+        for turn_slots in slots:
+            if not carry_session:
+                session = {}
+            LF1.validate_slots(turn_slots, session)
+    return (time.perf_counter() - start) / (conversations * len(slots))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conversations', type=int, default=5000)
+    args = parser.parse_args()
+
+    turns = conversation()
+    # warm up
+    run(turns, 100, True)
+
+    results = [
+        ('dialog turn, fresh session', run(turns, args.conversations, False)),
+        ('dialog turn, validated slots carried', run(turns, args.conversations, True)),
+        ('validate_slots only, fresh session', run_validation_only(turns, args.conversations, False)),
+        ('validate_slots only, carried', run_validation_only(turns, args.conversations, True))
+    ]
+
+    print(f'{args.conversations} conversations of {len(turns)} turns')
+    for name, seconds in results:
+        print(f'{name:40s} {seconds * 1e6:8.2f} us/turn')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,700 @@
+"""In-memory stand-ins for the services the Lambdas call.
+
+Every fake sleeps for an injected latency on each call and records it in
+a shared CallLog, so benchmarks can report calls per request and time
+per service. ``FakeServices(...).install()`` routes
+``clients.get_client`` and friends to the fakes through
+``clients.override``.
+"""
+import copy
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
+
+import clients
+import throttle
+
+
+# --------------------------------- latency and call accounting ---------------------------------
+
+class Latency:
+    # Milliseconds slept per call: `ms` on average, spread by +/- `jitter` of it
+
+    def __init__(self, ms=0.0, jitter=0.2):
+        self.ms = float(ms)
+        self.jitter = jitter
+
+    def sample(self):
+        if self.ms <= 0:
+            return 0.0
+        return max(0.0, random.uniform(1 - self.jitter, 1 + self.jitter) * self.ms / 1000.0)
+
+    def wait(self):
+        delay = self.sample()
+        if delay:
+            time.sleep(delay)
+
+class CallLog:
+    # Thread-safe record of every fake call: (service, operation) -> durations
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = defaultdict(list)
+
+    @contextmanager
+    def call(self, service, operation, latency):
+        start = time.perf_counter()
+        latency.wait()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.durations[(service, operation)].append(elapsed)
+
+    def counts(self):
+        with self._lock:
+            return {key: len(durations) for key, durations in self.durations.items()}
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(durations) for key, durations in self.durations.items()}
+
+    def reset(self):
+        with self._lock:
+            self.durations.clear()
+
+class FakeService:
+    service = None
+
+    def __init__(self, log, latency):
+        self.log = log
+        self.latency = latency
+
+    def _call(self, operation):
+        return self.log.call(self.service, operation, self.latency)
+
+
+def response_metadata():
+    return {
+        'RequestId': str(uuid.uuid4()),
+        'HTTPStatusCode': 200,
+        'HTTPHeaders': {'date': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())}
+    }
+
+
+# --------------------------------- SQS ---------------------------------
+
+class FakeSQS(FakeService):
+    service = 'sqs'
+
+    def __init__(self, log, latency):
+        super().__init__(log, latency)
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._in_flight = {}
+        self._deduplication_ids = set()
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, DelaySeconds=0,
+                     MessageDeduplicationId=None, MessageGroupId=None):
+        # DelaySeconds is not simulated, messages are visible at once
+        with self._call('send_message'):
+            message_id = str(uuid.uuid4())
+            with self._lock:
+                if MessageDeduplicationId is not None:
+                    if MessageDeduplicationId in self._deduplication_ids:
+                        return {'MessageId': message_id, 'ResponseMetadata': response_metadata()}
+                    self._deduplication_ids.add(MessageDeduplicationId)
+                self._queue.append({
+                    'MessageId': message_id,
+                    'ReceiptHandle': message_id,
+                    'Body': MessageBody,
+                    'MessageAttributes': MessageAttributes or {}
+                })
+            return {'MessageId': message_id, 'ResponseMetadata': response_metadata()}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        with self._call('send_message_batch'):
+            with self._lock:
+                for entry in Entries:
+                    message_id = str(uuid.uuid4())
+                    self._queue.append({
+                        'MessageId': message_id,
+                        'ReceiptHandle': message_id,
+                        'Body': entry['MessageBody'],
+                        'MessageAttributes': entry.get('MessageAttributes') or {}
+                    })
+            return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': [], 'ResponseMetadata': response_metadata()}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        with self._call('receive_message'):
+            messages = []
+            with self._lock:
+                while self._queue and len(messages) < MaxNumberOfMessages:
+                    message = self._queue.popleft()
+                    self._in_flight[message['ReceiptHandle']] = message
+                    messages.append(message)
+            return {'Messages': messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        with self._call('delete_message_batch'):
+            with self._lock:
+                for entry in Entries:
+                    self._in_flight.pop(entry['ReceiptHandle'], None)
+            return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def take_records(self, count):
+        # up to `count` queued messages as an SQS event source would deliver them
+        with self._lock:
+            messages = [self._queue.popleft() for _ in range(min(count, len(self._queue)))]
+
+        records = []
+        for message in messages:
+            records.append({
+                'messageId': message['MessageId'],
+                'receiptHandle': message['ReceiptHandle'],
+                'body': message['Body'],
+                'messageAttributes': {
+                    name: {'stringValue': attribute['StringValue'], 'dataType': attribute['DataType']}
+                    for name, attribute in message['MessageAttributes'].items()
+                },
+                'eventSource': 'aws:sqs'
+            })
+        return records
+
+    def __len__(self):
+        with self._lock:
+            return len(self._queue)
+
+
+# --------------------------------- SNS ---------------------------------
+
+class FakeSNS(FakeService):
+    # With a `rate`, publishes beyond it per second (bursts up to `burst`)
+    # fail with the Throttled error SNS returns for SMS over the account limit
+    service = 'sns'
+
+    def __init__(self, log, latency, rate=None, burst=None):
+        super().__init__(log, latency)
+        self._lock = threading.Lock()
+        self._limit = throttle.TokenBucket(rate, burst) if rate else None
+        self.published = []
+        self.throttled = 0
+
+    def publish(self, PhoneNumber, Message, **kwargs):
+        with self._call('publish'):
+            if self._limit is not None and not self._limit.try_acquire():
+                with self._lock:
+                    self.throttled += 1
+                raise ClientError({'Error': {'Code': 'Throttled', 'Message': 'Rate exceeded'}}, 'Publish')
+            with self._lock:
+                self.published.append((PhoneNumber, Message))
+            return {'MessageId': str(uuid.uuid4()), 'ResponseMetadata': response_metadata()}
+
+
+# --------------------------------- S3 ---------------------------------
+
+class FakeS3(FakeService):
+    service = 's3'
+
+    def __init__(self, log, latency):
+        super().__init__(log, latency)
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        with self._call('put_object'):
+            self.objects[(Bucket, Key)] = bytes(Body)
+            return {'ResponseMetadata': response_metadata()}
+
+    def download_file(self, Bucket, Key, Filename):
+        with self._call('download_file'):
+            with open(Filename, 'wb') as f:
+                f.write(self.objects[(Bucket, Key)])
+
+
+# --------------------------------- DynamoDB ---------------------------------
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+class _Exceptions:
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+
+class _Meta:
+    class client:
+        exceptions = _Exceptions
+
+# one clause of an update expression: SET a = :x, b = :y / ADD a :x / REMOVE a, b
+UPDATE_CLAUSE = re.compile(r'\b(SET|ADD|REMOVE)\b')
+
+# the conditions the Lambdas use on updates: `a = :x`, attribute_exists(a)
+# and attribute_not_exists(a), joined by AND
+EXISTS = re.compile(r'attribute_(not_)?exists\((\w+)\)')
+
+def condition_holds(item, expression, values):
+    for condition in expression.split(' AND '):
+        exists = EXISTS.fullmatch(condition.strip())
+        if exists:
+            holds = (exists.group(2) in item) != bool(exists.group(1))
+        else:
+            name, value = (side.strip() for side in condition.split('='))
+            holds = item.get(name) == values[value]
+        if not holds:
+            return False
+    return True
+
+def project(item, projection, names):
+    if not projection:
+        return dict(item)
+    fields = [names.get(field.strip(), field.strip()) for field in projection.split(',')]
+    return {field: item[field] for field in fields if field in item}
+
+class FakeTable:
+    meta = _Meta
+
+    def __init__(self, dynamodb, name):
+        self.dynamodb = dynamodb
+        self.name = name
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        return self.dynamodb._call(operation)
+
+    def get_item(self, Key, ConsistentRead=False, **kwargs):
+        with self._call('get_item'):
+            with self._lock:
+                item = self.items.get(Key['id'])
+            return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        with self._call('put_item'):
+            with self._lock:
+                existing = self.items.get(Item['id'])
+                # the only condition the Lambdas use: absent or expired
+                if ConditionExpression and existing is not None:
+                    if existing.get('expiresAt', 0) > ExpressionAttributeValues[':now']:
+                        raise ConditionalCheckFailedException(Item['id'])
+                self.items[Item['id']] = dict(Item)
+            return {}
+
+    def delete_item(self, Key):
+        with self._call('delete_item'):
+            with self._lock:
+                self.items.pop(Key['id'], None)
+            return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ReturnValues=None,
+                    ConditionExpression=None, **kwargs):
+        with self._call('update_item'):
+            values = ExpressionAttributeValues or {}
+            parts = UPDATE_CLAUSE.split(UpdateExpression)[1:]
+            with self._lock:
+                if ConditionExpression and not condition_holds(self.items.get(Key['id'], {}), ConditionExpression, values):
+                    raise ConditionalCheckFailedException(Key['id'])
+                item = self.items.setdefault(Key['id'], dict(Key))
+                updated = {}
+                for action, clause in zip(parts[::2], parts[1::2]):
+                    for assignment in filter(None, (part.strip() for part in clause.split(','))):
+                        if action == 'SET':
+                            name, value = (side.strip() for side in assignment.split('='))
+                            item[name] = updated[name] = values[value]
+                        elif action == 'ADD':
+                            name, value = assignment.split()
+                            if isinstance(values[value], set):
+                                item[name] = updated[name] = item.get(name, set()) | values[value]
+                            else:
+                                item[name] = updated[name] = item.get(name, 0) + values[value]
+                        else:
+                            item.pop(assignment, None)
+            return {'Attributes': updated} if ReturnValues else {}
+
+    def scan(self, ProjectionExpression=None, ExpressionAttributeNames=None, ExclusiveStartKey=None, **kwargs):
+        with self._call('scan'):
+            with self._lock:
+                items = list(self.items.values())
+            return {'Items': [project(item, ProjectionExpression, ExpressionAttributeNames or {}) for item in items]}
+
+class FakeDynamoDB(FakeService):
+    # Stands in for the boto3 DynamoDB resource
+    service = 'dynamodb'
+
+    def __init__(self, log, latency):
+        super().__init__(log, latency)
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def Table(self, name):
+        with self._lock:
+            table = self._tables.get(name)
+            if table is None:
+                table = self._tables[name] = FakeTable(self, name)
+            return table
+
+    def batch_get_item(self, RequestItems):
+        with self._call('batch_get_item'):
+            responses = {}
+            for name, request in RequestItems.items():
+                table = self.Table(name)
+                names = request.get('ExpressionAttributeNames', {})
+                with table._lock:
+                    found = [table.items.get(key['id']) for key in request['Keys']]
+                responses[name] = [project(item, request.get('ProjectionExpression'), names) for item in found if item]
+            return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems):
+        with self._call('batch_write_item'):
+            for name, requests in RequestItems.items():
+                table = self.Table(name)
+                with table._lock:
+                    for request in requests:
+                        item = request['PutRequest']['Item']
+                        table.items[item['id']] = dict(item)
+            return {'UnprocessedItems': {}}
+
+
+# --------------------------------- Lex ---------------------------------
+
+class FakeLex(FakeService):
+    # Turns each message into a complete DiningSuggestionsIntent and runs
+    # LF1 the way Lex does on the turn that fills the last slot: a
+    # DialogCodeHook validation, then the fulfillment. Messages are
+    # 'slot=value' pairs separated by ';'.
+    service = 'lex-runtime'
+
+    def __init__(self, log, latency, code_hook):
+        super().__init__(log, latency)
+        self.code_hook = code_hook
+
+    def post_text(self, botName, botAlias, userId, inputText):
+        with self._call('post_text'):
+            slots = dict(pair.split('=', 1) for pair in inputText.split(';'))
+            request = {
+                'userId': userId,
+                'sessionAttributes': {},
+                'currentIntent': {'name': 'DiningSuggestionsIntent', 'slots': slots},
+                'invocationSource': 'DialogCodeHook'
+            }
+            response = self.code_hook(request, None)
+
+            if response['dialogAction']['type'] == 'Delegate':
+                request = dict(request, invocationSource='FulfillmentCodeHook', sessionAttributes=response['sessionAttributes'])
+                response = self.code_hook(request, None)
+
+            return {
+                'message': response['dialogAction'].get('message', {}).get('content', ''),
+                'dialogState': response['dialogAction']['type'],
+                'ResponseMetadata': response_metadata()
+            }
+
+
+# --------------------------------- Elasticsearch ---------------------------------
+
+def field_values(document, path):
+    # every value at a dotted path, descending into lists
+    values = [document]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                found.extend(item.get(part) for item in value if isinstance(item, dict))
+            elif isinstance(value, dict):
+                found.append(value.get(part))
+        values = [value for value in found if value is not None]
+    flattened = []
+    for value in values:
+        flattened.extend(value if isinstance(value, list) else [value])
+    return flattened
+
+def matches(document, clause):
+    kind, spec = next(iter(clause.items()))
+    if kind == 'terms':
+        field, wanted = next(iter(spec.items()))
+        return bool(set(field_values(document, field)).intersection(wanted))
+    if kind == 'term':
+        field, wanted = next(iter(spec.items()))
+        return wanted in field_values(document, field)
+    if kind == 'match':
+        field, text = next(iter(spec.items()))
+        field = field[:-len('.text')] if field.endswith('.text') else field
+        return any(str(text).lower() in str(value).lower() for value in field_values(document, field))
+    if kind == 'geo_bounding_box':
+        field, box = next(iter(spec.items()))
+        location = document.get(field)
+        if not location:
+            return False
+        return (box['bottom_right']['lat'] <= location['lat'] <= box['top_left']['lat']
+                and box['top_left']['lon'] <= location['lon'] <= box['bottom_right']['lon'])
+    if kind == 'bool':
+        return all(matches(document, inner) for inner in spec.get('filter', []) + spec.get('must', []))
+    if kind == 'match_all':
+        return True
+    raise NotImplementedError(f'query clause {kind}')
+
+class _Indices:
+    def __init__(self, es):
+        self.es = es
+
+    def exists(self, index):
+        with self.es._call('indices.exists'):
+            return index in self.es.indices_data or index in self.es.aliases
+
+    def create(self, index, body=None, params=None):
+        with self.es._call('indices.create'):
+            self.es.indices_data.setdefault(index, {})
+            self.es.settings[index] = {}
+            return {'acknowledged': True}
+
+    def get_settings(self, index, name=None):
+        with self.es._call('indices.get_settings'):
+            return {concrete: {'settings': {'index': dict(self.es.settings.get(concrete, {}))}}
+                    for concrete in self.es.resolve(index)}
+
+    def put_settings(self, index, body):
+        with self.es._call('indices.put_settings'):
+            for concrete in self.es.resolve(index):
+                for name, value in body['index'].items():
+                    self.es.settings.setdefault(concrete, {})[name] = value
+            return {'acknowledged': True}
+
+    def refresh(self, index):
+        with self.es._call('indices.refresh'):
+            return {}
+
+    def exists_alias(self, name):
+        with self.es._call('indices.exists_alias'):
+            return name in self.es.aliases
+
+    def get_alias(self, name):
+        with self.es._call('indices.get_alias'):
+            return {index: {'aliases': {name: {}}} for index in self.es.aliases.get(name, [])}
+
+    def update_aliases(self, body):
+        with self.es._call('indices.update_aliases'):
+            with self.es._lock:
+                for action in body['actions']:
+                    kind, spec = next(iter(action.items()))
+                    if kind == 'add':
+                        self.es.aliases.setdefault(spec['alias'], []).append(spec['index'])
+                    elif kind == 'remove':
+                        self.es.aliases.get(spec['alias'], []).remove(spec['index'])
+                    elif kind == 'remove_index':
+                        self.es.indices_data.pop(spec['index'], None)
+            return {'acknowledged': True}
+
+    def get(self, index):
+        with self.es._call('indices.get'):
+            prefix = index.rstrip('*')
+            return {name: {} for name in self.es.indices_data if name.startswith(prefix)}
+
+    def delete(self, index):
+        with self.es._call('indices.delete'):
+            self.es.indices_data.pop(index, None)
+            return {'acknowledged': True}
+
+class _Transport:
+    def __init__(self):
+        from elasticsearch.serializer import JSONSerializer
+        self.serializer = JSONSerializer()
+
+class FakeElasticsearch(FakeService):
+    # With `reject_every`, every n-th new document is rejected with a 429
+    # the first time it is sent, as a busy cluster does, and goes in when it
+    # is sent again
+    service = 'elasticsearch'
+
+    def __init__(self, log, latency, reject_every=None):
+        super().__init__(log, latency)
+        self._lock = threading.RLock()
+        self.reject_every = reject_every
+        # (index, id) of the rejected documents
+        self.rejected = set()
+        self._first_writes = 0
+        # index -> id -> source
+        self.indices_data = {}
+        self.aliases = {}
+        self.settings = {}
+        self.indices = _Indices(self)
+        self.transport = _Transport()
+
+    def resolve(self, index):
+        with self._lock:
+            if index in self.aliases:
+                return list(self.aliases[index])
+            return [index]
+
+    def search(self, index, body):
+        with self._call('search'):
+            with self._lock:
+                documents = [source for concrete in self.resolve(index)
+                             for source in self.indices_data.get(concrete, {}).values()]
+
+            query = body.get('query', {'match_all': {}})
+            if 'function_score' in query:
+                function_score = query['function_score']
+                hits = [document for document in documents if matches(document, function_score['query'])]
+                seed = function_score.get('random_score', {}).get('seed', 0)
+                hits.sort(key=lambda document: hashlib.md5(f"{seed}{document['id']}".encode()).digest())
+            else:
+                hits = [document for document in documents if matches(document, query)]
+
+            # field sorts, with search_after paging, as in [{"id": "asc"}]
+            sort_fields = [next(iter(field)) for field in body.get('sort', []) if isinstance(field, dict)]
+            sort_key = lambda document: [document.get(field) for field in sort_fields]
+            if sort_fields:
+                hits.sort(key=sort_key)
+                if 'search_after' in body:
+                    hits = [document for document in hits if sort_key(document) > list(body['search_after'])]
+
+            hits = hits[:body.get('size', 10)]
+            fields = body.get('_source')
+            sources = hits
+            if isinstance(fields, list):
+                sources = [{field: document[field] for field in fields if field in document} for document in hits]
+            return {'hits': {'total': {'value': len(hits)}, 'hits': [
+                dict({'_source': source}, **({'sort': sort_key(document)} if sort_fields else {}))
+                for source, document in zip(sources, hits)
+            ]}}
+
+    def count(self, index):
+        with self._call('count'):
+            with self._lock:
+                return {'count': sum(len(self.indices_data.get(concrete, {})) for concrete in self.resolve(index))}
+
+    def _rejects(self, concrete, document_id):
+        key = (concrete, document_id)
+        if not self.reject_every or key in self.rejected or document_id in self.indices_data.get(concrete, {}):
+            return False
+        self._first_writes += 1
+        if self._first_writes % self.reject_every:
+            return False
+        self.rejected.add(key)
+        return True
+
+    def bulk(self, body, index=None, doc_type=None, params=None, headers=None, **kwargs):
+        with self._call('bulk'):
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+            items = []
+            with self._lock:
+                position = 0
+                while position < len(lines):
+                    operation, meta = next(iter(lines[position].items()))
+                    concrete = self.resolve(meta.get('_index', index))[0]
+                    documents = self.indices_data.setdefault(concrete, {})
+                    if operation == 'delete':
+                        status = 200 if documents.pop(meta['_id'], None) is not None else 404
+                        position += 1
+                    elif self._rejects(concrete, meta['_id']):
+                        status = 429
+                        position += 2
+                    else:
+                        documents[meta['_id']] = lines[position + 1]
+                        status = 201
+                        position += 2
+                    items.append({operation: {'_id': meta['_id'], 'status': status}})
+            return {'took': 1, 'errors': any(200 > item[op]['status'] or item[op]['status'] >= 300
+                                             for item in items for op in item), 'items': items}
+
+
+# --------------------------------- Yelp ---------------------------------
+
+class FakeYelpResponse:
+    def __init__(self, status_code, payload, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps(payload)
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f'Yelp answered {self.status_code}')
+
+# Yelp category per CUISINES search term
+YELP_CATEGORIES = {
+    'korean': ('korean', 'Korean'),
+    'chinese': ('chinese', 'Chinese'),
+    'coffee': ('coffee', 'Coffee & Tea'),
+    'american': ('newamerican', 'American (New)'),
+    'indian': ('indpak', 'Indian'),
+    'japanese': ('japanese', 'Japanese')
+}
+
+class FakeYelp(FakeService):
+    # Serves `total` deterministic businesses per search term, spread over
+    # Manhattan and Brooklyn, through the business search endpoint
+    service = 'yelp'
+
+    def __init__(self, log, latency, total=200):
+        super().__init__(log, latency)
+        self.total = total
+
+    def business(self, term, number):
+        alias, title = YELP_CATEGORIES.get(term.split()[0], ('restaurants', 'Restaurants'))
+        rng = random.Random(f'{term}-{number}')
+        business_id = hashlib.sha1(f'{term}-{number}'.encode()).hexdigest()[:22]
+        return {
+            'id': business_id,
+            'name': f'{title} place {number}',
+            'categories': [{'alias': alias, 'title': title}],
+            'rating': rng.choice([3.0, 3.5, 4.0, 4.5, 5.0]),
+            'review_count': rng.randint(0, 3000),
+            'coordinates': {'latitude': rng.uniform(40.64, 40.88), 'longitude': rng.uniform(-74.02, -73.91)},
+            'location': {
+                'display_address': [f'{number} Broadway', 'New York, NY 10001'],
+                'zip_code': '10001'
+            }
+        }
+
+    def get(self, url, headers=None, params=None):
+        with self._call('search'):
+            offset, limit = int(params['offset']), int(params['limit'])
+            end = min(self.total, offset + limit)
+            businesses = [self.business(params['term'], number) for number in range(offset, end)]
+            return FakeYelpResponse(200, {'total': self.total, 'businesses': businesses})
+
+
+# --------------------------------- wiring ---------------------------------
+
+# milliseconds per call, roughly what the services take from inside us-east-1
+DEFAULT_LATENCY_MS = {
+    'lex-runtime': 60,
+    'sqs': 8,
+    'sns': 25,
+    's3': 20,
+    'dynamodb': 5,
+    'elasticsearch': 12,
+    'yelp': 150
+}
+
+class FakeServices:
+    def __init__(self, latency_ms=None, code_hook=None, yelp_total=200, sns_rate=None):
+        latency_ms = dict(DEFAULT_LATENCY_MS, **(latency_ms or {}))
+        self.log = CallLog()
+        self.sqs = FakeSQS(self.log, Latency(latency_ms['sqs']))
+        self.sns = FakeSNS(self.log, Latency(latency_ms['sns']), rate=sns_rate)
+        self.s3 = FakeS3(self.log, Latency(latency_ms['s3']))
+        self.dynamodb = FakeDynamoDB(self.log, Latency(latency_ms['dynamodb']))
+        self.lex = FakeLex(self.log, Latency(latency_ms['lex-runtime']), code_hook)
+        self.elasticsearch = FakeElasticsearch(self.log, Latency(latency_ms['elasticsearch']))
+        self.yelp = FakeYelp(self.log, Latency(latency_ms['yelp']), total=yelp_total)
+
+    def install(self):
+        clients.override('sqs', self.sqs)
+        clients.override('sns', self.sns)
+        clients.override('s3', self.s3)
+        clients.override('dynamodb', self.dynamodb)
+        clients.override('lex-runtime', self.lex)
+        clients.override('elasticsearch', self.elasticsearch)
+        clients.override('http', self.yelp)
+        return self
+
+    def uninstall(self):
+        for name in ['sqs', 'sns', 's3', 'dynamodb', 'lex-runtime', 'elasticsearch', 'http']:
+            clients.override(name, None)
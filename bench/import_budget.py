@@ -0,0 +1,110 @@
+"""Import-time budget for the Lambda handlers.
+
+Imports each handler in a fresh interpreter with ``python -X importtime``,
+the same work a cold start does before the first invocation, and reports
+what every top-level module cost. Fails when a handler goes over its
+budget or imports a module that must stay lazy.
+
+    python bench/import_budget.py
+    python bench/import_budget.py --handler LF2 --top 15
+"""
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Lambda')
+
+# milliseconds of cumulative import time per handler, measured on a laptop,
+# Lambda cold starts are slower but the ratios hold
+BUDGET_MS = {
+    'LF0': 50,
+    'LF1': 50,
+    'LF2': 50,
+    'LF-Yelp': 100
+}
+
+# only loaded on the paths that need them
+LAZY_MODULES = ['boto3', 'botocore', 'elasticsearch', 'requests', 'requests_aws4auth', 'numpy', 'dateutil']
+
+
+def import_times(handler, python=sys.executable):
+    # (self_us, cumulative_us, depth, module) per imported module, in import order
+    result = subprocess.run(
+        [python, '-X', 'importtime', '-c', f'__import__({handler!r})'],
+        cwd=LAMBDA_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'importing {handler} failed:\n{result.stderr}')
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # one separating space, then two spaces per level of nesting
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+def handler_rows(handler, rows):
+    # importtime lists a module after everything it imported, so the
+    # handler's imports are the rows between the previous top-level row and its own
+    start = 0
+    for i, (_, _, depth, name) in enumerate(rows):
+        if depth == 0:
+            if name == handler:
+                return rows[start:i + 1]
+            start = i + 1
+    raise RuntimeError(f'{handler} is missing from the import time report')
+
+def summarize(handler, rows):
+    # cumulative milliseconds of the handler and of every module it
+    # imports directly (depth 1 in the importtime tree)
+    handler_ms = rows[-1][1] / 1000.0
+    top_level = defaultdict(float)
+    for _, cumulative_us, depth, name in rows:
+        if depth == 1:
+            top_level[name] += cumulative_us / 1000.0
+    return handler_ms, dict(top_level)
+
+def eager_lazy_modules(handler, rows):
+    loaded = {name.split('.')[0] for _, _, _, name in rows}
+    return sorted(module for module in LAZY_MODULES if module in loaded)
+
+def check(handler, top):
+    rows = handler_rows(handler, import_times(handler))
+    handler_ms, top_level = summarize(handler, rows)
+    budget = BUDGET_MS[handler]
+    eager = eager_lazy_modules(handler, rows)
+
+    print(f'{handler}: {handler_ms:.1f} ms (budget {budget} ms), {len(rows)} modules')
+    for name, ms in sorted(top_level.items(), key=lambda item: -item[1])[:top]:
+        print(f'    {ms:8.1f} ms  {name}')
+
+    problems = []
+    if handler_ms > budget:
+        problems.append(f'{handler} takes {handler_ms:.1f} ms to import, over its {budget} ms budget')
+    if eager:
+        problems.append(f'{handler} imports {", ".join(eager)} at import time')
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--handler', action='append', choices=sorted(BUDGET_MS), help='handler to check, default all')
+    parser.add_argument('--top', type=int, default=10, help='modules listed per handler')
+    args = parser.parse_args()
+
+    problems = []
+    for handler in args.handler or list(BUDGET_MS):
+        problems.extend(check(handler, args.top))
+
+    for problem in problems:
+        print(f'FAIL {problem}')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())